@@ -0,0 +1,79 @@
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+from src.file_store import ChunkIndex, ChunkTable
+
+
+class LegacyChunk:
+    """Chunk as it was stored before ChunkTable: a regular object with an instance dict."""
+    def __init__(self, chunk_hash, offset, size, peers=None):
+        self.chunk_hash = chunk_hash
+        self.offset = offset
+        self.size = size
+        self.peers = peers
+
+
+def build_legacy(entries, file_hash):
+    chunks = {}
+    for digest, offset, size in entries:
+        chunk_hash = f"chunk:{digest.hex()}"
+        chunks[chunk_hash] = LegacyChunk(chunk_hash, offset, size)
+    file_chunks = {chunk_hash: file_hash for chunk_hash in chunks}
+    return chunks, file_chunks
+
+
+def build_compact(entries, file_hash):
+    chunks = ChunkTable(entries)
+    chunk_index = ChunkIndex()
+    chunk_index.add(file_hash, chunks.digest_list())
+    return chunks, chunk_index
+
+
+def legacy_locations(file_chunks, key):
+    return file_chunks[key]
+
+
+def compact_locations(chunk_index, key):
+    return chunk_index.get(bytes.fromhex(key[6:]))
+
+
+def measure(build, entries, file_hash):
+    """Bytes allocated by build: the per-file chunk mapping plus the store-wide chunk -> file index."""
+    gc.collect()
+    tracemalloc.start()
+    result = build(entries, file_hash)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def bench_lookups(lookup, keys):
+    start_time = time.perf_counter()
+    for key in keys:
+        lookup(key)
+    return (time.perf_counter() - start_time) / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare memory use of the legacy and compact chunk indexes.")
+    parser.add_argument("--chunks", type=int, default=1_000_000, help="Number of chunks to index.")
+    args = parser.parse_args()
+    chunk_size = 4 * 1024 * 1024
+    entries = [(os.urandom(32), i * chunk_size, chunk_size) for i in range(args.chunks)]
+    file_hash = f"file:{os.urandom(32).hex()}"
+    keys = [f"chunk:{entries[i][0].hex()}" for i in range(0, args.chunks, max(args.chunks // 10000, 1))]
+
+    print(f"{args.chunks} chunks")
+    print(f"    {'layout':<10} {'total':>12} {'per chunk':>12} {'lookup':>12} {'locate':>12}")
+    for name, build, locate in [("legacy", build_legacy, legacy_locations), ("compact", build_compact, compact_locations)]:
+        (chunks, file_chunks), size = measure(build, entries, file_hash)
+        lookup = bench_lookups(chunks.__getitem__, keys)
+        location = bench_lookups(lambda key: locate(file_chunks, key), keys)
+        print(f"    {name:<10} {size / 1024**2:>9.1f} MB {size / args.chunks:>10.1f} B {lookup:>9.2f} us {location:>9.2f} us")
+        del chunks, file_chunks
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import os
+import tempfile
+import time
+from src.hashing import HASH_ALGORITHMS, ChunkHasher, new_hash
+from src.file_store import DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+
+def bench_single(algorithm, data, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        new_hash(algorithm, data).digest()
+    return len(data) * repeat / (time.perf_counter() - start_time)
+
+
+def bench_file(algorithm, file_path, file_size, chunk_size):
+    hasher = ChunkHasher()
+    ranges = [(offset, min(chunk_size, file_size - offset)) for offset in range(0, file_size, chunk_size)]
+    start_time = time.perf_counter()
+    for _ in hasher.hash_ranges(file_path, ranges, algorithm):
+        pass
+    elapsed = time.perf_counter() - start_time
+    hasher.shutdown()
+    return file_size / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure hashing throughput per algorithm.")
+    parser.add_argument("--size", type=int, default=256, help="Size of the test file in MB.")
+    args = parser.parse_args()
+    file_size = args.size * 1024 * 1024
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(file_size))
+        f.flush()
+        print(f"{args.size} MB file, {os.cpu_count()} cores")
+        print(f"    {'algorithm':<10} {'1 thread':>12} {'8 KB chunks':>14} {'4 MB chunks':>14}")
+        for algorithm in sorted(HASH_ALGORITHMS):
+            single = bench_single(algorithm, os.urandom(MAX_CHUNK_SIZE), max(file_size // MAX_CHUNK_SIZE, 1))
+            small = bench_file(algorithm, f.name, file_size, DEFAULT_CHUNK_SIZE)
+            large = bench_file(algorithm, f.name, file_size, MAX_CHUNK_SIZE)
+            print(f"    {algorithm:<10} {single / 1024**2:>7.0f} MB/s {small / 1024**2:>9.0f} MB/s {large / 1024**2:>9.0f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,80 @@
 import asyncio
 import argparse
 import aioconsole
+import time
 from kademlia.network import Server
-from src import file_store, file_server, file_download
+from src import file_store, file_server, file_download, manifest, metrics, peer_stats
+from src.hashing import HASH_ALGORITHMS
 from src.utils import serialize, deserialize, get_internal_ip
 
 DOWNLOAD_RATE = file_server.DOWNLOAD_RATE
 MAX_PEERS = 30
 
+DHT_SECONDS = metrics.histogram('dht_request_seconds', "Time for a DHT get or set", ['operation'])
+
 class UserExit(Exception):
     pass
 
 class PeerNetwork:
-    def __init__(self, base_directory, kademlia_port=9001, server_port=8000, bootstrap_addr=("0.0.0.0", 9000), interval=5, cmd_line=True, download_rate=DOWNLOAD_RATE):
+    def __init__(self, base_directory, kademlia_port=9001, server_port=8000, bootstrap_addr=("0.0.0.0", 9000), interval=5, cmd_line=True, download_rate=DOWNLOAD_RATE, chunker=None, merkle=False,
+                 hash_algorithm='sha256'):
         self.base_directory = base_directory
         self.ip = get_internal_ip()
         self.port = kademlia_port
         self.bootstrap_addr = bootstrap_addr
         self.interval = interval
         self.cmd_line = cmd_line
-        self.file_store = file_store.FileStore(base_directory)
+        self.file_store = file_store.FileStore(base_directory, chunker=chunker, merkle=merkle,
+                                               hash_algorithm=hash_algorithm)
         self.debug = False
         self.kademlia_server = Server()
         self.file_server = file_server.FileServer(self.file_store, self.ip, server_port, download_rate)
+        self.peer_stats = peer_stats.PeerStats()    # How each peer has performed, kept across downloads
 
     async def init_kademlia(self):
         await self.kademlia_server.listen(self.port)
         if self.bootstrap_addr:
             await self.kademlia_server.bootstrap([self.bootstrap_addr])
 
+    async def dht_get(self, key):
+        start_time = time.perf_counter()
+        try:
+            return await self.kademlia_server.get(key)
+        finally:
+            DHT_SECONDS.labels('get').observe(time.perf_counter() - start_time)
+
+    async def dht_set(self, key, value):
+        start_time = time.perf_counter()
+        try:
+            return await self.kademlia_server.set(key, value)
+        finally:
+            DHT_SECONDS.labels('set').observe(time.perf_counter() - start_time)
+
     async def share_files(self):
         file_index = await self.find_hash("index:0")
         if not file_index:
             file_index = {}
         else:
             file_index = deserialize(file_index)
-        for file_hash, file in self.file_store.files.items():
+        announced_chunks = set()    # Chunks shared by several files are announced once
+        for file_hash, file in list(self.file_store.files.items()):
             if file_hash not in file_index:
                 file_index[file_hash] = file.file_name
             if not await self.find_hash(file_hash):
-                await self.kademlia_server.set(file_hash, file.metadata(serialized=True))
+                if file.has_manifest():
+                    for page_hash, page in file.manifest()[1].items():
+                        await self.dht_set(page_hash, page)
+                await self.dht_set(file_hash, file.metadata(serialized=True))
             share_chunk_coroutines = []
-            for chunk in file.chunks.values():
-                share_chunk_coroutines.append(self.share_chunk(chunk.chunk_hash))
+            for chunk_hash in file.chunks:
+                if chunk_hash not in announced_chunks:
+                    announced_chunks.add(chunk_hash)
+                    share_chunk_coroutines.append(self.share_chunk(chunk_hash))
             await asyncio.gather(*share_chunk_coroutines)
-        await self.kademlia_server.set("index:0", serialize(file_index))
+        await self.dht_set("index:0", serialize(file_index))
 
     async def share_chunk(self, chunk_hash):
-        chunk_data = await self.kademlia_server.get(chunk_hash)
+        chunk_data = await self.dht_get(chunk_hash)
         if chunk_data:
             chunk = deserialize(chunk_data)
             peers = set(chunk['peers'])
@@ -55,18 +82,36 @@ class PeerNetwork:
             chunk['peers'] = list(peers)
         else:
             chunk = {"peers": [f"{self.ip}:{self.file_server.port}"]}
-        await self.kademlia_server.set(chunk_hash, serialize(chunk))
+        await self.dht_set(chunk_hash, serialize(chunk))
 
     async def find_hash(self, file_hash):
-        return await self.kademlia_server.get(file_hash)
+        return await self.dht_get(file_hash)
 
     async def refresh_local_files(self):
-        """Refreshes local files available for sharing."""
-        while True:
-            if self.file_store.load_files():
+        """Refreshes local files available for sharing as the directory changes."""
+        async for found_new_files in self.file_store.watch(self.interval):
+            if found_new_files:
                 await self.file_server.update_file_store(self.file_store)
                 await self.share_files()
+
+    async def announce_downloads(self):
+        """Announce chunks of downloads in progress as they arrive, so other downloaders can fetch them here too."""
+        announced = {}    # Maps file hashes of downloads to the seq last announced
+        while True:
             await asyncio.sleep(self.interval)
+            partial_files = dict(self.file_store.partial_files)
+            for file_hash in set(announced) - set(partial_files):
+                del announced[file_hash]
+            for file_hash, partial in partial_files.items():
+                seq = announced.get(file_hash, 0)
+                if partial.seq == seq:
+                    continue
+                indices = partial.changes_since(seq)
+                if indices is None:
+                    indices = file_store.bitfield_indices(partial.bitfield, len(partial.chunks))
+                announced[file_hash] = partial.seq
+                chunk_hashes = {partial.chunks[index]['chunk_hash'] for index in indices}
+                await asyncio.gather(*(self.share_chunk(chunk_hash) for chunk_hash in chunk_hashes))
 
     async def download_file(self, file_hash):
         if not file_hash.startswith('file:'):
@@ -80,19 +125,35 @@ class PeerNetwork:
             chunks = []
             file_metadata = deserialize(file)
             file_metadata['file_hash'] = file_hash
+            if 'manifest' in file_metadata:
+                try:
+                    file_metadata['chunks'] = await manifest.resolve_manifest(file_metadata['manifest'], self.find_hash)
+                except ValueError as e:
+                    await aioconsole.aprint(f"{e}. Aborting download...")
+                    return False
             for chunk in file_metadata['chunks']:
                 chunk_hash = chunk['chunk_hash']
-                chunk_data = await self.kademlia_server.get(chunk_hash)
+                # A chunk held locally in another file is copied, but keeps its peers in case the copy fails
+                held_locally = self.file_store.get_file(chunk_hash) is not None
+                chunk_data = await self.dht_get(chunk_hash)
                 if chunk_data:
                     chunk_metadata = deserialize(chunk_data)
-                    chunk_peers = [x for x in chunk_metadata['peers'][0:MAX_PEERS] if x != f"{self.ip}:{self.file_server.port}"]
-                    if len(chunk_peers) == 0:
+                    chunk_peers = self.peer_stats.rank([x for x in chunk_metadata['peers'] if x != f"{self.ip}:{self.file_server.port}"])[0:MAX_PEERS]
+                    if len(chunk_peers) == 0 and not held_locally:
                         await aioconsole.aprint(f"No peers found for chunk {chunk_hash}. Aborting download...")
                         return False
                     chunk['peers'] = chunk_peers
                     chunks.append(chunk)
-            downloader = file_download.FileDownloader(self.base_directory, file_metadata, chunks)
+                elif held_locally:
+                    chunk['peers'] = []
+                    chunks.append(chunk)
+            downloader = file_download.FileDownloader(self.base_directory, file_metadata, chunks, self.file_store,
+                                                      peer_stats=self.peer_stats)
             status, failed_peers = await downloader.download_file()
+            if status:
+                # The store already holds the finished file, so the watcher will not report it as new
+                await self.file_server.update_file_store(self.file_store)
+                await self.share_files()
             return status
             # Remove failed peers from chunk metadata
             # for chunk_hash, peers in failed_peers:
@@ -167,7 +228,7 @@ class PeerNetwork:
         """Starts the peer network services."""
         await self.init_kademlia()
         await self.file_server.run()
-        async_tasks = [self.refresh_local_files()]
+        async_tasks = [self.refresh_local_files(), self.announce_downloads()]
         if self.cmd_line:
             async_tasks.append(self.process_user_input())
         await asyncio.gather(*async_tasks)
@@ -184,6 +245,8 @@ if __name__ == "__main__":
     parser.add_argument("--server_port", type=int, help="The port for file server to listen on.")
     parser.add_argument("--bootstrap", type=str, help="The address of the bootstrap node.")
     parser.add_argument("--dir", type=str, help="The directory to share files from.")
+    parser.add_argument("--hash", type=str, default="sha256", choices=sorted(HASH_ALGORITHMS),
+                        help="The hash algorithm used for local files.")
     base_directory = '/files/'
     bootstrap_node = "0.0.0.0:9000"
     kademlia_port = 9001
@@ -207,7 +270,8 @@ if __name__ == "__main__":
         base_directory=base_directory,
         kademlia_port=kademlia_port,
         server_port=server_port,
-        bootstrap_addr=bootstrap_addr
+        bootstrap_addr=bootstrap_addr,
+        hash_algorithm=args.hash
     )
     try:
         asyncio.run(peer_network.run())
@@ -1,29 +1,39 @@
+import aiohttp
 import asyncio
 import argparse
 import aioconsole
 import socket
-from src import file_store, file_server, file_download
+import time
+from collections import defaultdict
+from src import file_store, file_server, file_download, manifest, metrics, peer_stats
+from src.hashing import HASH_ALGORITHMS
 from src.utils import serialize, deserialize, get_internal_ip
 
 DOWNLOAD_RATE = file_server.DOWNLOAD_RATE
 MAX_PEERS = 30
 
+BROADCAST_RTT = metrics.histogram('broadcast_rtt_seconds', "Time from broadcasting a request to each response")
+
 class UserExit(Exception):
     pass
 
 class PeerNetwork:
-    def __init__(self, base_directory, port=9000, server_port=8000, broadcast_port=12346, timeout=1, cmd_line=True, download_rate=DOWNLOAD_RATE):
+    def __init__(self, base_directory, port=9000, server_port=8000, broadcast_port=12346, timeout=1, cmd_line=True, download_rate=DOWNLOAD_RATE, chunker=None, merkle=False,
+                 hash_algorithm='sha256'):
         self.base_directory = base_directory
         self.ip = get_internal_ip()
         self.port = port
         self.timeout = timeout
         self.cmd_line = cmd_line
-        self.file_store = file_store.FileStore(base_directory)
+        self.file_store = file_store.FileStore(base_directory, chunker=chunker, merkle=merkle,
+                                               hash_algorithm=hash_algorithm)
         self.debug = False
         self.file_server = file_server.FileServer(self.file_store, self.ip, server_port, download_rate)
+        self.peer_stats = peer_stats.PeerStats()    # How each peer has performed, kept across downloads
         self.broadcast_port = broadcast_port
         self.file_responses = {} # temporary storage for file responses
         self.responses = 0
+        self.request_time = None    # When the last request was broadcast
 
     def broadcast(self, message):
         # Send a broadcast message to the network
@@ -42,6 +52,7 @@ class PeerNetwork:
         self.file_responses[file_hash] = None
         self.responses = 0
         msg = serialize({"type": "request", "file_hash": file_hash, "addr": f"{self.ip}:{self.port}"})
+        self.request_time = time.perf_counter()
         self.broadcast(msg)
         if required_responses > 0:
             # Wait until we have the required number of responses
@@ -86,29 +97,34 @@ class PeerNetwork:
                 self.send_message(serialize(response), message_addr)
         else:
             file = self.file_store.get_file(file_hash)
+            partial = self.file_store.partial_files.get(file_hash)
             if file:
                 response = {"type": "response", "file_hash": file.hash(), "file": file.metadata(), "addr": f"{self.ip}:{self.file_server.port}"}
                 self.send_message(serialize(response), message_addr)
+            elif partial and partial.metadata and partial.available:
+                # Still downloading it; the requester asks /have which chunks can be fetched here
+                response = {"type": "response", "file_hash": file_hash, "file": partial.metadata, "partial": True,
+                            "addr": f"{self.ip}:{self.file_server.port}"}
+                self.send_message(serialize(response), message_addr)
 
     def handle_file_response(self, message):
         self.responses += 1
+        if self.request_time is not None:
+            BROADCAST_RTT.observe(time.perf_counter() - self.request_time)
         file = message['file']
         addr = message['addr']
         file_hash = message['file_hash']
-        file['peers'] = [addr]
         if not self.file_responses.get(file_hash):
-            self.file_responses[file_hash] = file
-        else:
-            self.file_responses[file_hash]['peers'].append(addr)
+            self.file_responses[file_hash] = dict(file, peers=[], partial_peers=[])
+        self.file_responses[file_hash]['partial_peers' if message.get('partial') else 'peers'].append(addr)
 
     async def find_hash(self, file_hash, required_responses=0):
         return await self.request_file(file_hash, required_responses)
 
     async def refresh_local_files(self):
-        """Refreshes local files available for sharing."""
-        while True:
-            self.file_store.load_files()
-            await asyncio.sleep(self.timeout)
+        """Refreshes local files available for sharing as the directory changes."""
+        async for _ in self.file_store.watch(self.timeout):
+            pass
 
     async def download_file(self, file_hash, required_responses=0):
         if not file_hash.startswith('file:'):
@@ -122,18 +138,43 @@ class PeerNetwork:
             chunks = []
             file_metadata = file
             file_metadata['file_hash'] = file_hash
-            for chunk in file_metadata['chunks']:
+            if 'manifest' in file_metadata:
+                try:
+                    async with aiohttp.ClientSession() as session:
+                        file_metadata['chunks'] = await manifest.fetch_manifest_from_peers(
+                            session, file_metadata['manifest'], file_metadata['peers'])
+                except ValueError as e:
+                    await aioconsole.aprint(f"{e}. Aborting download...")
+                    return False
+            holders = await self.partial_holders(file_hash, file_metadata['partial_peers'])
+            for index, chunk in enumerate(file_metadata['chunks']):
                 chunk_hash = chunk['chunk_hash']
-                chunk['peers'] = file_metadata['peers']
-                if len(chunk['peers']) == 0:
+                chunk['peers'] = self.peer_stats.rank(file_metadata['peers'] + holders[index])
+                # A chunk held locally in another file is copied, so it needs no peer
+                if len(chunk['peers']) == 0 and self.file_store.get_file(chunk_hash) is None:
                     await aioconsole.aprint(f"No peers found for chunk {chunk_hash}. Aborting download...")
                     return False
                 chunks.append(chunk)
-            downloader = file_download.FileDownloader(self.base_directory, file_metadata, chunks)
+            downloader = file_download.FileDownloader(self.base_directory, file_metadata, chunks, self.file_store,
+                                                      peer_stats=self.peer_stats)
             status, failed_peers = await downloader.download_file()
             return status
         return False
 
+    async def partial_holders(self, file_hash, partial_peers):
+        """Ask peers still downloading the file which chunks they can serve. Maps chunk indices to those peers."""
+        holders = defaultdict(list)
+        if not partial_peers:
+            return holders
+        async with aiohttp.ClientSession() as session:
+            replies = await asyncio.gather(*(file_download.fetch_have(session, peer, file_hash) for peer in partial_peers),
+                                           return_exceptions=True)
+        for peer, reply in zip(partial_peers, replies):
+            if not isinstance(reply, Exception):
+                for index in reply[0]:
+                    holders[index].append(peer)
+        return holders
+
     async def display_help(self):
         commands = {
             "ls": "display local files being shared",
@@ -207,6 +248,8 @@ if __name__ == "__main__":
     parser.add_argument("--server_port", type=int, help="The port for file server to listen on.")
     parser.add_argument("--broadcast_port", type=int, help="The port to broadcast on.")
     parser.add_argument("--dir", type=str, help="The directory to share files from.")
+    parser.add_argument("--hash", type=str, default="sha256", choices=sorted(HASH_ALGORITHMS),
+                        help="The hash algorithm used for local files.")
     base_directory = './files/'
     bootstrap_node = "0.0.0.0:9000"
     port = 9001
@@ -229,7 +272,8 @@ if __name__ == "__main__":
         base_directory=base_directory,
         port=port,
         server_port=server_port,
-        broadcast_port=broadcast_port
+        broadcast_port=broadcast_port,
+        hash_algorithm=args.hash
     )
     try:
         asyncio.run(peer_network.run())
@@ -1,4 +1,17 @@
+from . import assembly
+from . import bandwidth
+from . import chunk_cache
+from . import chunking
+from . import disk_io
+from . import download_journal
 from . import file_download
+from . import file_index
 from . import file_server
 from . import file_store
+from . import file_watcher
+from . import hashing
+from . import manifest
+from . import merkle
+from . import metrics
+from . import peer_stats
 from . import utils
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+from collections import deque
+from .hashing import new_hash, parse_hash
+
+BUFFER_BUDGET = 64 * 1024 * 1024    # Bytes a download may hold in memory at once
+STREAM_BLOCK_SIZE = 256 * 1024    # Bytes read from the network, written and hashed in one step
+
+
+class BufferBudget:
+    """Caps the bytes a download holds in memory.
+
+    Network reads wait for room with acquire. Data kept only to be hashed later takes room with
+    try_acquire, which never blocks and stops at half the budget, so reads always make progress.
+    """
+    def __init__(self, limit=BUFFER_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.waiters = deque()    # (size, future) in arrival order
+
+    async def acquire(self, size):
+        """Wait until size bytes fit. Returns the amount reserved, to be passed back to release."""
+        size = min(size, self.limit // 2)
+        if not self.waiters and self.used + size <= self.limit:
+            self._take(size)
+            return size
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((size, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiters.remove((size, future))
+            else:
+                self.release(size)
+            raise
+        return size
+
+    def try_acquire(self, size):
+        if self.used + size > self.limit // 2:
+            return False
+        self._take(size)
+        return True
+
+    def release(self, size):
+        self.used -= size
+        while self.waiters and self.used + self.waiters[0][0] <= self.limit:
+            size, future = self.waiters.popleft()
+            if not future.done():
+                self._take(size)
+                future.set_result(None)
+
+    def _take(self, size):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+
+class ChunkAssembler:
+    """Hashes a chunk in order while its pieces arrive out of order and go straight to disk.
+
+    Data at the hashing position is hashed at once. Data further on is kept in memory while the
+    budget allows, and otherwise read back from the file when the hashing position reaches it.
+    """
+    def __init__(self, pool, file_path, chunk, budget):
+        self.pool = pool
+        self.file_path = file_path
+        self.chunk = chunk
+        self.budget = budget
+        _, algorithm, self.hexdigest = parse_hash(chunk.chunk_hash)
+        self.hash = new_hash(algorithm)
+        self.position = chunk.offset    # Everything before this has been hashed
+        self.pending = {}    # Maps offsets ahead of position to (data, or None if it is only on disk, size)
+
+    async def add(self, offset, data):
+        """Account for data that has just been written at offset."""
+        if offset == self.position:
+            self.hash.update(data)
+            self.position += len(data)
+            await self._advance()
+        elif offset > self.position:
+            kept = self.budget.try_acquire(len(data))
+            self.pending[offset] = (data if kept else None, len(data))
+
+    async def add_on_disk(self, offset, size):
+        """Account for data already in the file, read back when the hashing position reaches it."""
+        self.pending[offset] = (None, size)
+        await self._advance()
+
+    async def _advance(self):
+        while self.position in self.pending:
+            data, size = self.pending.pop(self.position)
+            if data is None:
+                data = await self.pool.read(self.file_path, self.position, size)
+            else:
+                self.budget.release(size)
+            self.hash.update(data)
+            self.position += size
+
+    @property
+    def filled(self):
+        """Whether every byte of the chunk has been hashed."""
+        return self.position == self.chunk.offset + self.chunk.size
+
+    def finish(self):
+        """Release held data and report whether the whole chunk arrived and matches its hash."""
+        for data, size in self.pending.values():
+            if data is not None:
+                self.budget.release(size)
+        self.pending.clear()
+        return self.filled and self.hash.hexdigest() == self.hexdigest
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+MIN_SLICE_SIZE = 16 * 1024
+MAX_SLICE_SIZE = 1024 * 1024
+
+
+class BandwidthLimiter:
+    """Node-wide token bucket shared by every upload stream.
+
+    Tokens refill at rate bytes per second up to burst. A request is granted while the bucket is
+    positive and may drive it negative, so writes of any size keep the long-run average at rate.
+    Waiting requests are queued per peer and granted round-robin, so one peer with many streams
+    cannot starve the others. A rate of None disables limiting.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or self.default_burst(rate)
+        self.tokens = self.burst or 0
+        self.updated = time.monotonic()
+        self.queues = OrderedDict()    # Maps peers to deques of (size, future) awaiting tokens
+        self.dispatcher = None
+        self.wait_time = 0.0    # Total seconds requests spent waiting for tokens
+
+    @staticmethod
+    def default_burst(rate):
+        """A quarter second of traffic."""
+        return max(rate // 4, MIN_SLICE_SIZE) if rate else None
+
+    def set_rate(self, rate, burst=None):
+        """Change the total cap at runtime."""
+        if rate and not self.rate:
+            self.tokens = 0
+            self.updated = time.monotonic()
+        self.rate = rate
+        self.burst = burst or self.default_burst(rate)
+        if rate:
+            self.tokens = min(self.tokens, self.burst)
+
+    def slice_size(self):
+        """Largest write to request at once, small enough to keep low rates smooth."""
+        if not self.rate:
+            return MAX_SLICE_SIZE
+        return max(MIN_SLICE_SIZE, min(MAX_SLICE_SIZE, self.rate // 10))
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, peer, size):
+        """Wait until size bytes may be sent to peer."""
+        if not self.rate:
+            return
+        self._refill()
+        if not self.queues and self.tokens > 0:
+            self.tokens -= size
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(peer, deque()).append((size, future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+        start_time = time.monotonic()
+        try:
+            await future
+        finally:
+            self.wait_time += time.monotonic() - start_time
+
+    async def _dispatch(self):
+        while self.queues:
+            if not self.rate:
+                self.tokens = 0
+            else:
+                self._refill()
+                if self.tokens <= 0:
+                    await asyncio.sleep(-self.tokens / self.rate + 0.001)
+                    continue
+            # Serve the peer at the front, then move it to the back of the line
+            peer, queue = next(iter(self.queues.items()))
+            size, future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(peer)
+            else:
+                del self.queues[peer]
+            if future.done():
+                continue    # The stream went away while waiting
+            if self.rate:
+                self.tokens -= size
+            future.set_result(None)
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class ChunkCache:
+    """Byte-bounded LRU cache of chunk contents, keyed by chunk hash.
+
+    Each entry remembers the file and stat key it was read from and is dropped as soon as the
+    file store no longer lists that file with the same key.
+    """
+    def __init__(self, max_size=CHUNK_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()    # Maps chunk hashes to (memoryview, file path, stat key)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chunk_hash, file_store):
+        entry = self.entries.get(chunk_hash)
+        if entry is not None:
+            data, file_path, key = entry
+            if self.is_current(file_store, file_path, key):
+                self.entries.move_to_end(chunk_hash)
+                self.hits += 1
+                return data
+            self.discard(chunk_hash)
+        self.misses += 1
+        return None
+
+    def put(self, chunk_hash, data, file_path, key):
+        if len(data) > self.max_size:
+            return
+        self.discard(chunk_hash)
+        self.entries[chunk_hash] = (memoryview(data), file_path, key)
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, (old_data, _, _) = self.entries.popitem(last=False)
+            self.size -= len(old_data)
+
+    def discard(self, chunk_hash):
+        entry = self.entries.pop(chunk_hash, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def invalidate(self, file_store):
+        """Drop every entry read from a file that has since changed or left the store."""
+        for chunk_hash, (_, file_path, key) in list(self.entries.items()):
+            if not self.is_current(file_store, file_path, key):
+                self.discard(chunk_hash)
+
+    @staticmethod
+    def is_current(file_store, file_path, key):
+        entry = file_store.file_paths.get(file_path)
+        return entry is not None and entry[0] == key
@@ -0,0 +1,132 @@
+import hashlib
+import os
+from .hashing import read_into
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; boundaries are identical without it, only slower to find
+    np = None
+
+DEFAULT_MIN_SIZE = 2 * 1024
+DEFAULT_AVG_SIZE = 8 * 1024
+DEFAULT_MAX_SIZE = 64 * 1024
+SEGMENT_SIZE = 8 * 1024 * 1024
+WINDOW_SIZE = 32    # A 32-bit gear hash only depends on the last 32 bytes
+
+# Gear table shared by every node, so all of them cut the same content at the same places
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint32) if np is not None else None
+
+
+def _mask(bits):
+    # The high bits of the gear hash mix in the most bytes of the window
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+class ContentDefinedChunker:
+    """FastCDC-style content-defined chunking with a gear rolling hash and normalized chunk sizes.
+
+    A boundary is placed after the first byte whose hash matches a strict mask between min_size and
+    avg_size, or a looser mask between avg_size and max_size, so insertions only move nearby cuts.
+    """
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, avg_size=DEFAULT_AVG_SIZE, max_size=DEFAULT_MAX_SIZE):
+        if not WINDOW_SIZE * 2 <= min_size <= avg_size <= max_size:
+            raise ValueError("Chunk sizes must satisfy 64 <= min_size <= avg_size <= max_size")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length() - 1, 2)
+        self.mask_small = _mask(bits + 1)
+        self.mask_large = _mask(bits - 1)
+
+    def metadata(self):
+        return {"type": "cdc", "min_size": self.min_size, "avg_size": self.avg_size, "max_size": self.max_size}
+
+    def config(self):
+        return f"cdc:{self.min_size}:{self.avg_size}:{self.max_size}"
+
+    def ranges(self, file_path):
+        """Yield (offset, size) for each content-defined chunk of the file."""
+        file_size = os.path.getsize(file_path)
+        if file_size == 0:
+            return
+        segment_size = max(SEGMENT_SIZE, self.max_size * 4)
+        buffer = bytearray(min(segment_size, file_size))
+        with open(file_path, 'rb') as f, memoryview(buffer) as view:
+            offset = 0
+            while offset < file_size:
+                end = min(offset + segment_size, file_size)
+                with view[:end - offset] as data:
+                    read_into(f.fileno(), data, offset)    # Read rather than mapped, so truncation is an OSError
+                    sizes = self._cut_segment(data, end == file_size)
+                for size in sizes:
+                    yield offset, size
+                    offset += size
+
+    def _cut_segment(self, data, is_last):
+        """Return chunk sizes for the data, leaving an incomplete tail for the next segment."""
+        if np is not None:
+            hashes = self._gear_hashes(np.frombuffer(data, dtype=np.uint8))
+            find_cut = lambda pos, n: self._find_cut_vectorized(hashes, pos, n)
+        else:
+            find_cut = lambda pos, n: self._find_cut(data, pos, n)
+        sizes = []
+        pos = 0
+        length = len(data)
+        while pos < length:
+            remaining = length - pos
+            if remaining < self.max_size and not is_last:
+                break
+            size = find_cut(pos, remaining)
+            sizes.append(size)
+            pos += size
+        return sizes
+
+    @staticmethod
+    def _gear_hashes(data):
+        """Windowed gear hash at every position: sum(GEAR[data[i - k]] << k for k < 32) mod 2**32."""
+        gears = GEAR_ARRAY[data]
+        hashes = gears.copy()
+        for k in range(1, WINDOW_SIZE):
+            hashes[k:] += gears[:-k] << np.uint32(k)
+        return hashes
+
+    def _find_cut_vectorized(self, hashes, pos, remaining):
+        if remaining <= self.min_size:
+            return remaining
+        normal = min(self.avg_size, remaining)
+        limit = min(self.max_size, remaining)
+        hits = np.flatnonzero((hashes[pos + self.min_size:pos + normal] & self.mask_small) == 0)
+        if hits.size:
+            return self.min_size + int(hits[0]) + 1
+        hits = np.flatnonzero((hashes[pos + normal:pos + limit] & self.mask_large) == 0)
+        if hits.size:
+            return normal + int(hits[0]) + 1
+        return limit
+
+    def _find_cut(self, data, pos, remaining):
+        if remaining <= self.min_size:
+            return remaining
+        normal = min(self.avg_size, remaining)
+        limit = min(self.max_size, remaining)
+        gear = GEAR
+        h = 0
+        # Warm the hash up over the window preceding min_size; earlier bytes cannot affect it
+        for i in range(pos + self.min_size - WINDOW_SIZE, pos + self.min_size):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        mask = self.mask_small
+        for i in range(pos + self.min_size, pos + limit):
+            h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+            if i - pos >= normal:
+                mask = self.mask_large
+            if not h & mask:
+                return i - pos + 1
+        return limit
+
+
+def chunker_from_metadata(metadata):
+    """Return the chunker described by a file's metadata, or None for fixed-size chunks."""
+    chunking = metadata.get('chunking')
+    if chunking and chunking.get('type') == 'cdc':
+        return ContentDefinedChunker(chunking['min_size'], chunking['avg_size'], chunking['max_size'])
+    return None
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+IO_WORKERS = 8
+MAX_OPEN_FILES = 128
+
+
+class FilePool:
+    """Bounded LRU of open files shared by the file server and downloads.
+
+    Reads and writes are positional (pread/pwrite), so one descriptor serves any number of
+    concurrent requests, and they run on a dedicated thread pool. Each path is cached with a
+    version, such as its stat key; asking for a new version replaces the old descriptor.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES, workers=IO_WORKERS):
+        self.max_open = max_open
+        self.workers = workers
+        self.files = OrderedDict()    # Maps (path, writable) to (version, file)
+        self.users = {}    # Maps files to the number of callers holding them
+        self.retired = set()    # Files evicted while in use, closed on their last release
+        self.lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='disk-io')
+        return self._executor
+
+    def acquire(self, path, version=None, write=False):
+        """Return an open file for path, opening it if needed. Pair every call with release."""
+        key = (path, write)
+        with self.lock:
+            entry = self.files.get(key)
+            if entry is not None and entry[0] == version:
+                self.files.move_to_end(key)
+                self.users[entry[1]] += 1
+                return entry[1]
+        f = open(path, 'r+b' if write else 'rb', buffering=0)
+        with self.lock:
+            old = self.files.pop(key, None)
+            if old is not None:
+                self._retire(old[1])
+            self.files[key] = (version, f)
+            self.users[f] = 1
+            while len(self.files) > self.max_open:
+                self._retire(self.files.popitem(last=False)[1][1])
+        return f
+
+    def release(self, f):
+        with self.lock:
+            self.users[f] -= 1
+            if f in self.retired and not self.users[f]:
+                self.retired.discard(f)
+                del self.users[f]
+                f.close()
+
+    def _retire(self, f):
+        if self.users.get(f):
+            self.retired.add(f)
+        else:
+            self.users.pop(f, None)
+            f.close()
+
+    def discard(self, path):
+        """Close the cached descriptors for path, e.g. before it is renamed or removed."""
+        with self.lock:
+            for key in [(path, False), (path, True)]:
+                entry = self.files.pop(key, None)
+                if entry is not None:
+                    self._retire(entry[1])
+
+    def pread(self, path, offset, size, version=None):
+        f = self.acquire(path, version)
+        try:
+            return os.pread(f.fileno(), size, offset)
+        finally:
+            self.release(f)
+
+    def pwrite(self, path, offset, data):
+        f = self.acquire(path, write=True)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(f.fileno(), view, offset)
+                view = view[written:]
+                offset += written
+        finally:
+            self.release(f)
+
+    def sync(self, path):
+        """Flush writes made to path through the pool to stable storage."""
+        f = self.acquire(path, write=True)
+        try:
+            os.fsync(f.fileno())
+        finally:
+            self.release(f)
+
+    async def read(self, path, offset, size, version=None):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.pread, path, offset, size, version)
+
+    async def write(self, path, offset, data):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.pwrite, path, offset, data)
+
+    @asynccontextmanager
+    async def open(self, path, version=None, readahead=None):
+        """Hold an open file for reading; readahead=(offset, length) hints that the range is read next."""
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(self.executor, self.acquire, path, version)
+        try:
+            if readahead:
+                advise(f, *readahead)
+            yield f
+        finally:
+            self.release(f)
+
+    def close(self):
+        with self.lock:
+            for _, f in self.files.values():
+                self._retire(f)
+            self.files.clear()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def advise(f, offset, length):
+    """Start reading the range into the page cache ahead of time, where the platform supports it."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+default_pool = FilePool()
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import struct
+import zlib
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_MAGIC = b'download-journal 1\n'
+JOURNAL_INTERVAL = 1    # Seconds between journal flushes while downloading
+RECORD = struct.Struct('>II')    # Chunk index, checksum of the index
+
+
+def checksum(index):
+    return zlib.crc32(index.to_bytes(4, 'big'))
+
+
+class DownloadJournal:
+    """Append-only list of the chunks of a .download file that were written and verified.
+
+    Chunks are appended in batches, each only after the data file has been synced, so every chunk
+    the journal lists survives a crash. Records carry a checksum, so a torn last write is ignored.
+    The header pins the file hash, size and inode, so a journal never applies to another file.
+    """
+    def __init__(self, data_path, file_hash, file_size, pool):
+        self.data_path = data_path
+        self.path = data_path + JOURNAL_SUFFIX
+        self.file_hash = file_hash
+        self.file_size = file_size
+        self.pool = pool
+        self.file = None
+        self.done = set()    # Chunk indices durably recorded
+        self.pending = []    # Chunk indices recorded since the last flush
+        self.lock = asyncio.Lock()
+        self.stopping = asyncio.Event()
+        self.task = None
+
+    def header(self):
+        inode = os.stat(self.data_path).st_ino
+        info = {"file_hash": self.file_hash, "file_size": self.file_size, "inode": inode}
+        return JOURNAL_MAGIC + json.dumps(info).encode() + b'\n'
+
+    def load(self):
+        """Return the chunk indices recorded by an earlier run, or an empty set if nothing can be reused."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if os.path.getsize(self.data_path) != self.file_size:
+                return set()
+            header = self.header()
+        except FileNotFoundError:
+            return set()
+        if not data.startswith(header):
+            return set()
+        indices = set()
+        for offset in range(len(header), len(data) - RECORD.size + 1, RECORD.size):
+            index, check = RECORD.unpack_from(data, offset)
+            if check != checksum(index):
+                break    # Torn or garbled write; nothing after it was acknowledged
+            indices.add(index)
+        return indices
+
+    def create(self, done=()):
+        """Start a fresh journal listing done, which must already be on disk."""
+        self._close_file()
+        self.done = set(done)
+        self.pending = []
+        self.file = open(self.path, 'wb', buffering=0)    # A crash while rewriting only loses records
+        self.file.write(self.header() + b''.join(RECORD.pack(i, checksum(i)) for i in sorted(self.done)))
+        os.fsync(self.file.fileno())
+
+    def record(self, index):
+        if index not in self.done:
+            self.pending.append(index)
+
+    async def flush(self):
+        """Make the chunks recorded so far durable."""
+        async with self.lock:
+            indices, self.pending = self.pending, []
+            if indices and self.file:
+                await asyncio.get_running_loop().run_in_executor(self.pool.executor, self._append, indices)
+                self.done.update(indices)
+
+    def _append(self, indices):
+        self.pool.sync(self.data_path)    # Data first, so no record can point at unwritten chunks
+        self.file.write(b''.join(RECORD.pack(i, checksum(i)) for i in indices))
+        os.fsync(self.file.fileno())
+
+    def start(self, interval=JOURNAL_INTERVAL):
+        """Flush in the background every interval seconds until closed."""
+        self.stopping.clear()
+        self.task = asyncio.create_task(self.run(interval))
+
+    async def run(self, interval):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def close(self):
+        """Flush what is left and close the journal file."""
+        if self.task:
+            self.stopping.set()
+            task, self.task = self.task, None
+            await task
+        self._close_file()
+
+    def _close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self._close_file()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
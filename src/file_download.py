@@ -1,112 +1,822 @@
 import aiohttp
 import asyncio
-import aiofiles
+import base64
 import os
+import random
 import time
-import hashlib
 from aioconsole import aprint
-from .file_store import File, Chunk
+from collections import Counter, defaultdict, deque
+from . import metrics
+from .assembly import BUFFER_BUDGET, STREAM_BLOCK_SIZE, BufferBudget, ChunkAssembler
+from .disk_io import default_pool
+from .download_journal import DownloadJournal
+from .file_server import BATCH_FRAME, CHUNK_OFFSET_HEADER, MAX_BATCH_CHUNKS
+from .chunking import chunker_from_metadata
+from .file_store import File, Chunk, bitfield_indices, covers_file
+from .hashing import DEFAULT_ALGORITHM, new_hash, parse_hash, verify_hash
+from .merkle import MAX_PROOF_LEAVES, leaf_count, verify_blocks, verify_range_proof
+from .peer_stats import PeerStats
 
 MAX_ATTEMPTS = 3
+RESUME_SAMPLE = 4    # Journaled chunks rehashed as a spot check when a download resumes
+BATCH_CHUNK_SIZE = 256 * 1024    # Chunks up to this size are fetched several at a time from /batch
+BATCH_SIZE = 4 * 1024 * 1024    # Bytes asked for in one batch request
+MAX_IN_FLIGHT = 32    # Requests a download keeps open at once
+MAX_PER_PEER = 4    # Requests a download keeps open to any one peer
+WORK_UNIT_SIZE = 1024 * 1024    # Chunks are fetched in pieces of at most this size, on aligned boundaries
+ENDGAME_SIZE = 4 * 1024 * 1024    # Once less than this is left in flight, idle peers race the slowest requests
+DRAIN_SIZE = 256 * 1024    # Unread bytes a cut-short request still reads so its connection can be reused
+
+BYTES_RECEIVED = metrics.counter('bytes_received_total', "Bytes of chunk data downloaded, by peer", ['peer'])
+
+
+class CorruptPieceError(Exception):
+    pass
+
+
+class PeerBusyError(Exception):
+    """The peer has no free upload slot and asked to be retried after retry_after seconds."""
+    def __init__(self, peer, retry_after):
+        super().__init__(f"{peer} is busy")
+        self.retry_after = retry_after
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', 1))
+    except ValueError:
+        return 1
+
+
+async def fetch_have(session, peer, file_hash, since=None):
+    """Ask a peer which chunks of a file it holds.
+
+    Returns (indices, seq, complete). With since, indices may be only those gained after that
+    seq; otherwise, or if the peer no longer remembers that far back, they are all of them.
+    """
+    params = {"since": since} if since is not None else None
+    async with session.get(f"http://{peer}/have/{file_hash}", params=params) as response:
+        if response.status != 200:
+            raise Exception(f"Unexpected status {response.status}")
+        reply = await response.json()
+    if 'have' in reply:
+        return set(reply['have']), reply['seq'], reply['complete']
+    return set(bitfield_indices(base64.b64decode(reply['bitfield']), reply['count'])), reply['seq'], reply['complete']
+
+
+def shared_metadata(file_data):
+    """The file record of a download as its source published it, without what was added to fetch it."""
+    metadata = {key: value for key, value in file_data.items() if key not in ('file_hash', 'peers', 'partial_peers')}
+    if 'manifest' in metadata:
+        metadata.pop('chunks', None)    # Listed by the manifest instead
+    else:
+        metadata['chunks'] = [Chunk(chunk['chunk_hash'], chunk['offset'], chunk['size']).metadata()
+                              for chunk in metadata['chunks']]
+    return metadata
+
+
+class Piece:
+    """Bytes start..end of a chunk, fetched from one peer at a time; position is the next byte to fetch.
+
+    In the endgame a piece may race a rival over the same bytes. The rival keeps its data in buffer
+    rather than writing it, and whichever finishes first sets the other's halt event.
+    """
+    __slots__ = ('chunk', 'start', 'end', 'position', 'peer', 'excluded', 'rival', 'buffer', 'halt')
+
+    def __init__(self, chunk, start, end, excluded=()):
+        self.chunk = chunk
+        self.start = start
+        self.end = end    # Lowered when another peer takes over the tail
+        self.position = start
+        self.peer = None    # Peer currently fetching the piece
+        self.excluded = set(excluded)    # Peers that sent bad data for it
+        self.rival = None
+        self.buffer = None
+        self.halt = asyncio.Event()    # Every read races it, so a piece raced later is cut off mid-block
+
+    def halted(self):
+        return self.halt.is_set()
+
+
+class DownloadScheduler:
+    """Fetches chunks in fixed-size pieces that workers pull from a shared queue.
+
+    Each peer gets up to max_per_peer workers and the whole download at most max_in_flight
+    requests, so fast peers simply come back for more work sooner. Peers known to be slow get a
+    single worker, and are dropped once far behind the fastest. A worker that finds nothing
+    queued takes over the second half of the request in flight expected to finish last. When too
+    little is left to split, it races that request instead, and the first to finish cancels the other.
+
+    A chunk that fails its hash is repaired rather than failed: only the pieces found to be bad
+    are fetched again, from other peers, and the peers whose data had to change are quarantined.
+    """
+    def __init__(self, downloader, session, chunks, max_in_flight=MAX_IN_FLIGHT, max_per_peer=MAX_PER_PEER):
+        self.downloader = downloader
+        self.session = session
+        self.chunks = chunks
+        self.max_per_peer = max_per_peer
+        self.stats = downloader.peer_stats
+        self.active_peers = set()
+        self.dropped_peers = set()    # Stragglers no longer given new pieces
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.queue = deque()
+        self.in_flight = set()
+        self.assemblers = {}    # Maps chunk offsets to the assemblers of unfinished chunks
+        self.outstanding = Counter()    # Maps chunk offsets to their unfinished pieces
+        self.failed_peers = defaultdict(set)    # Maps chunk hashes to peers that failed them
+        self.sources = defaultdict(list)    # Maps chunk offsets to the (start, stop, peer) ranges written so far
+        self.suspects = defaultdict(list)    # Maps chunk offsets to (start, stop, peer, digest) of data replaced in repairs
+        self.repairs = Counter()    # Maps chunk offsets to the repairs tried
+        self.changed = asyncio.Event()
+        for chunk in chunks:
+            self.failed_peers[chunk.chunk_hash].update(downloader.rejected[chunk.chunk_hash])    # Bad batches
+            self.assemblers[chunk.offset] = ChunkAssembler(downloader.pool, downloader.temp_file_path, chunk,
+                                                           downloader.budget)
+            start, chunk_end = chunk.offset, chunk.offset + chunk.size
+            while start < chunk_end:
+                end = min((start // WORK_UNIT_SIZE + 1) * WORK_UNIT_SIZE, chunk_end)
+                self.queue.append(Piece(chunk, start, end - 1, downloader.rejected[chunk.chunk_hash]))
+                self.outstanding[chunk.offset] += 1
+                start = end
+
+    async def run(self):
+        """Fetch every chunk. Returns (chunk hash, peers that failed it) for each one."""
+        peers = [peer for peer in self.stats.rank({peer for chunk in self.chunks for peer in chunk.peers})
+                 if not self.stats.quarantined(peer)]
+        self.active_peers = set(peers)
+        best = max((self.stats.score(peer) for peer in peers if self.stats.known(peer)), default=0)
+        await asyncio.gather(*(self.worker(peer) for peer in peers for _ in range(self.worker_count(peer, best))))
+        while self.queue:
+            await self.finish_piece(self.queue.popleft())    # No peer could serve it
+        return [(chunk.chunk_hash, self.failed_peers[chunk.chunk_hash]) for chunk in self.chunks]
+
+    def worker_count(self, peer, best):
+        """A full set of workers for new peers and those near the best score, one for the rest."""
+        if not self.stats.known(peer) or self.stats.score(peer) >= best / 2:
+            return self.max_per_peer
+        return 1
+
+    async def worker(self, peer):
+        errors = 0    # Failed requests to this peer in a row
+        while errors <= MAX_ATTEMPTS and peer not in self.dropped_peers and not self.stats.quarantined(peer):
+            await self.slots.acquire()
+            piece = self.next_piece(peer)
+            if piece is None:
+                self.slots.release()
+                if not self.in_flight:
+                    return    # Nothing queued for this peer, and nothing that could come back
+                await self.changed.wait()
+                continue
+            delay = 0
+            piece.peer = peer
+            self.in_flight.add(piece)
+            try:
+                while piece.position <= piece.end and not piece.halted():
+                    start = piece.position
+                    try:
+                        await self.downloader.fetch_range(self.session, peer, piece, self.assemblers[piece.chunk.offset])
+                    finally:
+                        if piece.position > start and piece.buffer is None:
+                            self.sources[piece.chunk.offset].append((start, piece.position, peer))
+                if piece.rival:
+                    await self.settle_race(piece)
+                errors = 0
+                await self.finish_piece(piece)
+                await self.drop_if_straggler(peer)
+            except PeerBusyError as e:
+                # Not a failure: leave the piece to another peer and come back after the requested wait
+                await self.requeue(piece)
+                delay = e.retry_after
+            except CorruptPieceError as e:
+                # Bad data rather than a bad connection: never ask this peer for the piece again
+                await aprint(f"Rejected piece: {e}")
+                await self.quarantine(peer, piece.chunk)
+                piece.excluded.add(peer)
+                await self.requeue(piece)
+            except Exception:
+                errors += 1
+                self.stats.record_error(peer)
+                self.failed_peers[piece.chunk.chunk_hash].add(peer)
+                await self.requeue(piece)
+                delay = 0.5
+            finally:
+                self.in_flight.discard(piece)
+                piece.peer = None
+                self.slots.release()
+                self.notify()
+            if delay:
+                await asyncio.sleep(delay)
+
+    def usable(self, peer, piece):
+        return peer in piece.chunk.peers and peer not in piece.excluded and not self.stats.quarantined(peer)
+
+    def next_piece(self, peer):
+        for i, piece in enumerate(self.queue):
+            if self.usable(peer, piece):
+                del self.queue[i]
+                return piece
+        return self.steal(peer) or self.race(peer)
+
+    def steal(self, peer):
+        """Split the request in flight to another peer that would finish last and return its second half."""
+        victim = self.slowest_request(peer)
+        if victim is None:
+            return None
+        align = self.downloader.block_size or STREAM_BLOCK_SIZE
+        middle = (victim.position + (victim.end - victim.position + 1) // 2) // align * align
+        # Leave the victim the block it may be reading now, and take at least a block
+        if middle - victim.position < 2 * align or victim.end - middle + 1 < align:
+            return None
+        piece = Piece(victim.chunk, middle, victim.end, victim.excluded)
+        victim.end = middle - 1
+        self.outstanding[victim.chunk.offset] += 1
+        return piece
+
+    def slowest_request(self, peer):
+        """The request in flight to another peer, not already raced, that is expected to finish last."""
+        victims = [piece for piece in self.in_flight
+                   if piece.peer != peer and piece.rival is None and piece.position <= piece.end and self.usable(peer, piece)]
+        return max(victims, key=lambda piece: (piece.end - piece.position) / max(self.stats.score(piece.peer), 1),
+                   default=None)
+
+    def race(self, peer):
+        """In the endgame, return a duplicate of the slowest request in flight for peer to fetch as well."""
+        if sum(piece.end - piece.position + 1 for piece in self.in_flight) > ENDGAME_SIZE:
+            return None
+        victim = self.slowest_request(peer)
+        if victim is None:
+            return None
+        piece = Piece(victim.chunk, victim.position, victim.end, victim.excluded)
+        piece.rival, victim.rival = victim, piece
+        piece.buffer = bytearray()    # At most ENDGAME_SIZE across all races
+        self.outstanding[victim.chunk.offset] += 1
+        return piece
+
+    async def settle_race(self, piece):
+        """Called when a raced piece stops. If it finished first, halt its rival and keep its own data."""
+        buffer, piece.buffer = piece.buffer, None
+        if piece.halted():
+            return    # The rival won; anything buffered is dropped
+        rival = piece.rival
+        rival.halt.set()
+        if buffer is not None:
+            # The rival was writing to disk; take over from the first byte it had not claimed
+            cut = max(rival.position, piece.start)
+            rival.end = min(rival.end, cut - 1)
+            data = bytes(buffer[cut - piece.start:piece.end - piece.start + 1])
+            if data:
+                await self.downloader.write_chunk_to_file(cut, data)
+                await self.assemblers[piece.chunk.offset].add(cut, data)
+                self.sources[piece.chunk.offset].append((cut, cut + len(data), piece.peer))
+
+    async def drop_if_straggler(self, peer):
+        """Stop giving work to a peer far slower than the others, once every chunk it serves has another source."""
+        if peer in self.dropped_peers or not self.stats.is_straggler(peer, self.active_peers):
+            return
+        others = self.active_peers - {peer}
+        if all(others.intersection(chunk.peers) for chunk in self.chunks if peer in chunk.peers):
+            self.dropped_peers.add(peer)
+            self.active_peers.discard(peer)
+            await aprint(f"Dropping slow peer {peer}")
+
+    async def requeue(self, piece):
+        if piece.rival and not piece.rival.halted():
+            # Its rival still covers the rest of the range
+            piece.buffer = None
+            piece.end = piece.position - 1
+            piece.halt.set()
+            await self.finish_piece(piece)
+            return
+        if piece.rival:
+            # Both sides of a race failed: go on as an ordinary piece from wherever the writing side stopped
+            if piece.buffer is not None:
+                piece.start = piece.position = max(piece.rival.position, piece.start)
+            piece.rival = piece.buffer = None
+        if not any(self.usable(peer, piece) for peer in piece.chunk.peers):
+            await self.finish_piece(piece)    # No peer left to try; the chunk fails
+        else:
+            self.queue.appendleft(piece)
+
+    async def finish_piece(self, piece):
+        chunk = piece.chunk
+        self.outstanding[chunk.offset] -= 1
+        if self.outstanding[chunk.offset]:
+            return
+        del self.outstanding[chunk.offset]
+        assembler = self.assemblers.pop(chunk.offset)
+        if assembler.finish():
+            await aprint(f"Downloaded chunk: {chunk.chunk_hash}")
+            self.downloader.mark_chunk(chunk)
+            self.sources.pop(chunk.offset, None)
+            for start, stop, peer, digest in self.suspects.pop(chunk.offset, ()):
+                if await self.downloader.digest_on_disk(chunk, start, stop) != digest:
+                    await self.quarantine(peer, chunk)    # The chunk only verified once its data was replaced
+        elif not assembler.filled or not await self.repair(chunk):
+            await aprint(f"Failed to download chunk: {chunk.chunk_hash}")
+
+    async def quarantine(self, peer, chunk):
+        self.failed_peers[chunk.chunk_hash].add(peer)
+        await self.downloader.reject(peer, chunk)
+
+    async def repair(self, chunk):
+        """Queue the pieces that spoiled a chunk to be fetched again. Returns False if that is not possible.
+
+        Each piece is checked against digests of its range from other peers, and only those shown to
+        be bad are fetched again, each from a peer other than its sender. Failing that, the pieces
+        no peer vouched for are, and failing that every piece; their senders stay usable if no
+        other peer is left. Senders are quarantined only if their data changed once the chunk verifies.
+        """
+        self.repairs[chunk.offset] += 1
+        if self.repairs[chunk.offset] > MAX_ATTEMPTS:
+            return False
+        sources = self.sources.pop(chunk.offset, [])
+        intact = {}
+        checks = await asyncio.gather(*(self.check_source(chunk, intact, *source) for source in sources))
+        checked = list(zip(sources, checks))
+        bad = ([(source, digest, True) for source, (ok, digest) in checked if ok is False]
+               or [(source, digest, False) for source, (ok, digest) in checked if ok is None]
+               or [(source, digest, False) for source, (_, digest) in checked])
+        pieces = []
+        for (start, stop, peer), _, confirmed in bad:
+            piece = Piece(chunk, start, stop - 1, {peer})
+            if not confirmed and not any(self.usable(other, piece) for other in chunk.peers):
+                piece.excluded.clear()    # Its sender may be the only good peer left
+            pieces.append(piece)
+        if not all(any(self.usable(peer, piece) for peer in chunk.peers) for piece in pieces):
+            return False
+        for (start, stop, peer), digest, _ in bad:
+            digest = digest or await self.downloader.digest_on_disk(chunk, start, stop)
+            self.suspects[chunk.offset].append((start, stop, peer, digest))
+        await aprint(f"Refetching {len(pieces)} of {len(sources)} pieces of chunk {chunk.chunk_hash}")
+        assembler = ChunkAssembler(self.downloader.pool, self.downloader.temp_file_path, chunk, self.downloader.budget)
+        self.assemblers[chunk.offset] = assembler
+        bad_sources = [source for source, _, _ in bad]
+        self.sources[chunk.offset] = [source for source in sources if source not in bad_sources]
+        for start, stop, _ in sorted(self.sources[chunk.offset]):
+            await assembler.add_on_disk(start, stop - start)
+        self.outstanding[chunk.offset] = len(pieces)
+        self.queue.extendleft(pieces)
+        self.notify()
+        return True
+
+    async def check_source(self, chunk, intact, start, stop, peer):
+        """Whether the data peer sent for start..stop matches other peers' digests, and the digest on disk.
+
+        Any other peer with the same digest clears it. A different digest from a peer whose copy of
+        the whole chunk is intact, or the same different digest from two other peers, shows it is
+        bad, as does a quarantined sender. Returns (None, digest) when that cannot be settled.
+        """
+        try:
+            local = await self.downloader.digest_on_disk(chunk, start, stop)
+        except OSError:
+            return None, None
+        if self.stats.quarantined(peer):
+            return False, local    # Already caught sending bad data
+        mismatches = Counter()
+        for other in self.stats.rank(chunk.peers):
+            if other == peer or self.stats.quarantined(other):
+                continue
+            try:
+                digest = await self.downloader.fetch_digest(self.session, other, chunk, start, stop)
+            except Exception:
+                continue
+            if digest == local:
+                return True, local
+            mismatches[digest] += 1
+            if mismatches[digest] == 2 or await self.holds_intact(chunk, other, intact):
+                return False, local
+        return None, local
+
+    async def holds_intact(self, chunk, peer, intact):
+        """Whether peer's copy of the whole chunk matches its hash. intact caches the answers of one repair."""
+        if peer not in intact:
+            intact[peer] = asyncio.ensure_future(
+                self.downloader.fetch_digest(self.session, peer, chunk, chunk.offset, chunk.offset + chunk.size))
+        try:
+            return await intact[peer] == parse_hash(chunk.chunk_hash)[2]
+        except Exception:
+            return False
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
 
 class FileDownloader:
-    def __init__(self, base_directory, file_data, chunks):
+    def __init__(self, base_directory, file_data, chunks, file_store=None, buffer_budget=BUFFER_BUDGET,
+                 max_in_flight=MAX_IN_FLIGHT, max_per_peer=MAX_PER_PEER, peer_stats=None):
         self.base_directory = base_directory
         self.file_data = file_data
         self.chunks = chunks
-        self.file_path = self.base_directory + '/' + self.file_data['file_name']
+        self.file_store = file_store    # Local chunks found here are copied instead of downloaded
+        self.file_path = os.path.join(self.base_directory, self.file_data['file_name'])
         self.temp_file_path = self.file_path + '.download'
-        self.file_lock = asyncio.Lock()
+        self.pool = default_pool    # Positional writes, so chunks land concurrently without a lock
+        self.merkle_root = file_data.get('merkle_root')
+        self.block_size = file_data.get('merkle_block_size')
+        # Chunks are journaled and published by their index in the file's own chunk list, which callers may filter
+        self.file_chunks = file_data.get('chunks', chunks)
+        self.chunk_positions = {chunk['offset']: i for i, chunk in enumerate(self.file_chunks)}
+        self.partial = None    # Progress published through the file store while downloading
+        self.budget = BufferBudget(buffer_budget)    # Bounds the data held in memory, however large the chunks
+        self.max_in_flight = max_in_flight
+        self.max_per_peer = max_per_peer
+        self.peer_stats = peer_stats or PeerStats()    # Shared by a node's downloads to favour peers that did well
+        self.verified = set()    # Indices of chunks written and checked against their hash
+        self.merkle_leaves = {}    # Maps block indices to leaf hashes checked against the Merkle root
+        self.rejected = defaultdict(set)    # Maps chunk hashes to peers that sent bad data for them
+        self.chunk_bound_peers = set()    # Peers without the whole file, which cannot send blocks past a chunk's edges
+        self.journal = DownloadJournal(self.temp_file_path, file_data['file_hash'], file_data['file_size'], self.pool)
 
     def init_file(self):
         file_size = self.file_data['file_size']
         with open(self.temp_file_path, 'wb') as file:
             file.truncate(file_size)
 
-    async def download_piece(self, session, chunk, start, end, peers):
-        failed_peers = set()
-        while not peers.empty():
-            peer = await peers.get()
-            url = f"http://{peer}/chunks/{chunk.chunk_hash}"
-            headers = {"Range": f"bytes={start}-{end}"}
-            attempt = 0
-            while attempt < MAX_ATTEMPTS:
-                try:
-                    async with session.get(url, headers=headers) as response:
-                        if response.status == 206:
-                            return await response.read(), failed_peers
+    async def resume(self, chunks):
+        """Keep the chunks an interrupted download recorded in its journal. Returns the offsets of those kept.
+
+        Only a sample of them is rehashed; if any of it fails, every recorded chunk is checked, and
+        those not in chunks are dropped. Otherwise they stay journaled for a later run.
+        """
+        indices = self.journal.load()
+        recorded = [chunk for chunk in chunks if self.chunk_positions[chunk.offset] in indices]
+        unlisted = indices - {self.chunk_positions[chunk.offset] for chunk in chunks}
+        sample = random.sample(recorded, min(RESUME_SAMPLE, len(recorded)))
+        if not all(await asyncio.gather(*(self.verify_on_disk(chunk) for chunk in sample))):
+            await aprint("Journal spot check failed. Verifying every recorded chunk...")
+            recorded = await self.chunks_on_disk(recorded)
+            unlisted = set()
+        if recorded or unlisted:
+            await aprint(f"Resuming download: {len(recorded)} of {len(chunks)} chunks already verified")
+        else:
+            self.init_file()
+        self.journal.create(unlisted.union(self.chunk_positions[chunk.offset] for chunk in recorded))
+        return {chunk.offset for chunk in recorded}
+
+    async def chunks_on_disk(self, chunks):
+        """Return the chunks whose data in the temp file matches their hash."""
+        valid = await asyncio.gather(*(self.verify_on_disk(chunk) for chunk in chunks))
+        return [chunk for chunk, ok in zip(chunks, valid) if ok]
+
+    async def verify_on_disk(self, chunk):
+        digest = await self.digest_on_disk(chunk, chunk.offset, chunk.offset + chunk.size)
+        return digest == parse_hash(chunk.chunk_hash)[2]
+
+    async def digest_on_disk(self, chunk, start, stop):
+        """Hash bytes start..stop of the temp file with the chunk's algorithm."""
+        hash = new_hash(parse_hash(chunk.chunk_hash)[1])
+        for offset in range(start, stop, STREAM_BLOCK_SIZE):
+            hash.update(await self.pool.read(self.temp_file_path, offset, min(STREAM_BLOCK_SIZE, stop - offset)))
+        return hash.hexdigest()
+
+    async def fetch_digest(self, session, peer, chunk, start, stop):
+        """Ask a peer for the digest of bytes start..stop of the file, which lie within chunk."""
+        url = f"http://{peer}/digest/{chunk.chunk_hash}"
+        params = {"start": start - chunk.offset, "end": stop - 1 - chunk.offset}
+        async with session.get(url, params=params) as response:
+            if response.status != 200:
+                raise Exception(f"Unexpected status {response.status}")
+            return (await response.json())['digest']
+
+    async def fetch_range(self, session, peer, piece, assembler):
+        """Stream a piece from a peer into the temp file block by block, advancing piece.position as blocks land.
+
+        With a Merkle root, whole blocks are fetched and each is verified before it is written. Peers
+        without the whole file, such as those still downloading it, send only the part of a block
+        inside the chunk, which is left to the chunk hash to check.
+        """
+        chunk = piece.chunk
+        start, end = piece.position, piece.end
+        fetch_start, fetch_end, block_size = start, end, STREAM_BLOCK_SIZE
+        file_size = self.file_data['file_size']
+        if self.merkle_root:
+            block_size = self.block_size
+            first = start // block_size
+            last = min(end // block_size, first + MAX_PROOF_LEAVES - 1)
+            leaves = await self.leaves_for(session, peer, first, last)
+            fetch_start = first * block_size
+            fetch_end = min((last + 1) * block_size, file_size) - 1
+            if peer in self.chunk_bound_peers:
+                fetch_start, fetch_end = max(fetch_start, chunk.offset), min(fetch_end, chunk.offset + chunk.size - 1)
+        url = f"http://{peer}/chunks/{chunk.chunk_hash}"
+        headers = {"Range": f"bytes={fetch_start}-{fetch_end}", CHUNK_OFFSET_HEADER: str(chunk.offset)}
+        request_time = time.perf_counter()
+        rtt = None
+        received = 0    # Counted however the request ends, so stolen and halted requests still rate the peer
+        failed = True
+        retry = False
+        try:
+            async with session.get(url, headers=headers) as response:
+                rtt = time.perf_counter() - request_time
+                if response.status == 503:
+                    raise PeerBusyError(peer, retry_after(response))
+                if response.status == 416 and self.merkle_root and peer not in self.chunk_bound_peers:
+                    self.chunk_bound_peers.add(peer)    # Not bad data: ask again for just the bytes inside the chunk
+                    failed, retry = False, True
+                    return
+                if response.status != 206:
+                    raise Exception(f"Unexpected status {response.status}")
+                offset = fetch_start
+                while offset <= fetch_end and piece.position <= piece.end and not piece.halted():
+                    size = min(block_size - offset % block_size if self.merkle_root else block_size, fetch_end - offset + 1)
+                    reserved = await self.budget.acquire(size)
+                    try:
+                        data = await self.read_block(response, size, piece)
+                        if data is None:
+                            break    # Halted mid-block
+                        block_offset, offset = offset, offset + size
+                        received += size
+                        BYTES_RECEIVED.labels(peer).inc(size)
+                        if piece.halted():
+                            continue    # The rival finished while this block arrived
+                        whole = block_offset % block_size == 0 and size == min(block_size, file_size - block_offset)
+                        if self.merkle_root and whole:    # Partial blocks from partial peers are left to the chunk hash
+                            index = block_offset // block_size
+                            if verify_blocks(data, index, leaves[index - first:index - first + 1], block_size) is not None:
+                                raise CorruptPieceError(f"Corrupt block {index} from {peer}")
+                        end = piece.end    # Lower than requested if another peer took over the tail
+                        if block_offset < start or offset - 1 > end:
+                            data = data[max(start - block_offset, 0):end - block_offset + 1]
+                        write_offset = max(block_offset, start)
+                        piece.position = write_offset + len(data)    # Claimed before writing, so a rival never writes it too
+                        if piece.buffer is not None:
+                            piece.buffer += data
                         else:
-                            raise Exception
-                except Exception as e:
-                    failed_peers.add(peer)
-                    attempt += 1
-                    await asyncio.sleep(0.5)
+                            await self.write_chunk_to_file(write_offset, data)
+                            await assembler.add(write_offset, data)
+                    finally:
+                        self.budget.release(reserved)
+                if not response.closed and 0 < fetch_end - offset + 1 <= DRAIN_SIZE:
+                    await response.content.readexactly(fetch_end - offset + 1)    # Cheaper than a new connection
+                    received += fetch_end - offset + 1
+            failed = False
+        finally:
+            if rtt is not None:
+                self.peer_stats.record_transfer(peer, received, time.perf_counter() - request_time, rtt, failed)
+        if retry:
+            await self.fetch_range(session, peer, piece, assembler)
+
+    async def read_block(self, response, size, piece):
+        """Read size bytes of a response. Returns None if the piece is halted before they all arrive."""
+        read = asyncio.ensure_future(response.content.readexactly(size))
+        halt = asyncio.ensure_future(piece.halt.wait())
+        try:
+            await asyncio.wait((read, halt), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            halt.cancel()
+            if not read.done():
+                read.cancel()
+                response.close()    # Cut off mid-block, so the connection cannot be reused
+        return read.result() if read.done() and not read.cancelled() else None    # A cancelled read is not done yet
+
+    async def fetch_leaves(self, session, peer, first, last):
+        """Fetch the leaf hashes of blocks first..last and check that they belong to the Merkle root."""
+        url = f"http://{peer}/proof/{self.merkle_root}"
+        async with session.get(url, params={"first": first, "last": last}) as response:
+            if response.status != 200:
+                raise Exception(f"Unexpected status {response.status}")
+            proof = await response.json()
+        count = leaf_count(self.file_data['file_size'], self.block_size)
+        if (len(proof['leaves']) != last - first + 1
+                or not verify_range_proof(self.merkle_root, count, first, proof['leaves'], proof['proof'])):
+            raise CorruptPieceError(f"Invalid Merkle proof from {peer}")
+        self.merkle_leaves.update(zip(range(first, last + 1), proof['leaves']))
+        return proof['leaves']
+
+    async def leaves_for(self, session, peer, first, last):
+        """Leaf hashes of blocks first..last, from those already checked, from peer, or else from any peer.
+
+        Peers still downloading the file cannot prove its blocks, so their pieces are checked this way.
+        """
+        if all(i in self.merkle_leaves for i in range(first, last + 1)):
+            return [self.merkle_leaves[i] for i in range(first, last + 1)]
+        try:
+            return await self.fetch_leaves(session, peer, first, last)
+        except CorruptPieceError:
+            raise
+        except Exception:
+            return await self.fetch_leaves_from_any(session, first, last, exclude=peer)
+
+    async def fetch_leaves_from_any(self, session, first, last, exclude=None):
+        peers = self.peer_stats.rank({peer for chunk in self.chunks for peer in chunk['peers'] if peer != exclude})
+        for peer in peers:
             try:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 206:
-                        return await response.read(), failed_peers
-                    else:
-                        raise Exception
-            except Exception as e:
-                failed_peers.add(peer)
-        return None, failed_peers
-
-    async def download_chunk(self, session, chunk):
-        num_peers = len(chunk.peers)
-        piece_size = chunk.size // num_peers
-        download_coroutines = []
-        for i, peer in enumerate(chunk.peers):
-            start = chunk.offset + i * piece_size
-            end = start + piece_size - 1 if i < num_peers - 1 else chunk.offset + chunk.size - 1
-            peers = asyncio.Queue()
-            [await peers.put(chunk.peers[(i + j) % num_peers]) for j in range(num_peers)]
-            download_coroutines.append(self.download_piece(session, chunk, start, end, peers))
-        result = await asyncio.gather(*download_coroutines, return_exceptions=True)
-        all_failed_peers = set()
-        chunk_data = b''
-        for piece, failed_peers in result:
-            all_failed_peers.update(failed_peers)
-            if piece:
-                chunk_data += piece
-        chunk_hash = hashlib.sha256(chunk_data).hexdigest()
-        if chunk_hash == chunk.chunk_hash.split(":")[1]:
-            await aprint(f"Downloaded chunk: {chunk.chunk_hash}")
-        else:
-            await aprint(f"Failed to download chunk: {chunk.chunk_hash}")
-        async with self.file_lock:
-            await self.write_chunk_to_file(chunk.offset, chunk_data)
-        return chunk.chunk_hash, all_failed_peers
+                return await self.fetch_leaves(session, peer, first, last)
+            except Exception:
+                continue
+        raise Exception(f"No peer sent Merkle leaves {first}-{last}")
+
+    async def verified_file(self, session):
+        """Build the finished file from the chunk hashes checked while downloading, instead of rehashing it."""
+        leaves = None
+        if self.merkle_root:
+            count = leaf_count(self.file_data['file_size'], self.block_size)
+            await self.fetch_missing_leaves(session, count)
+            leaves = b''.join(bytes.fromhex(self.merkle_leaves[i]) for i in range(count))
+        return File.from_metadata(self.file_path, {**self.file_data, 'chunks': self.chunks}, leaves)
+
+    def hashed_file(self):
+        """Hash the finished file from disk, for chunk lists that leave part of it unchecked."""
+        file = File(self.temp_file_path, self.file_data['file_name'], self.file_data['chunk_size'],
+                    chunker_from_metadata(self.file_data), merkle=bool(self.merkle_root),
+                    hash_algorithm=self.file_data.get('hash_algorithm', DEFAULT_ALGORITHM))
+        file.file_path = self.file_path
+        return file
+
+    async def fetch_missing_leaves(self, session, count):
+        """Fetch the leaf hashes of blocks that arrived without one, such as batched, copied or resumed chunks."""
+        first = 0
+        while first < count:
+            if first in self.merkle_leaves:
+                first += 1
+                continue
+            last = first
+            while last + 1 < count and last + 1 - first < MAX_PROOF_LEAVES and last + 1 not in self.merkle_leaves:
+                last += 1
+            await self.fetch_leaves_from_any(session, first, last)
+            first = last + 1
+
+    async def reject(self, peer, chunk):
+        """Count bad data for chunk against peer and stop using it, saying so once when it enters quarantine."""
+        self.peer_stats.record_error(peer)
+        self.rejected[chunk.chunk_hash].add(peer)
+        if not self.peer_stats.quarantined(peer):
+            self.peer_stats.quarantine(peer)
+            await aprint(f"Quarantined peer {peer}")
+
+    async def download_batches(self, session, chunks):
+        """Fetch small chunks through batch requests, giving each peer a contiguous run of them.
+
+        Returns the offsets of the chunks that were written; the rest are left for download_chunk.
+        """
+        runs = {}
+        for i, chunk in enumerate(chunks):
+            if chunk.peers:    # Chunks no peer has are left to fail in the scheduler
+                runs.setdefault(chunk.peers[i * len(chunk.peers) // len(chunks)], []).append(chunk)
+        batches = []
+        for peer, run in runs.items():
+            batch, batch_size = [], 0
+            for chunk in run:
+                if batch and (batch_size + chunk.size > BATCH_SIZE or len(batch) == MAX_BATCH_CHUNKS):
+                    batches.append((peer, batch))
+                    batch, batch_size = [], 0
+                batch.append(chunk)
+                batch_size += chunk.size
+            batches.append((peer, batch))
+        results = await asyncio.gather(*(self.download_batch(session, peer, batch) for peer, batch in batches))
+        return set().union(set(), *results)
+
+    async def download_batch(self, session, peer, chunks):
+        """Fetch whole chunks from one peer in a single request and write those that verify."""
+        written = set()
+        url = f"http://{peer}/batch"
+        request_time = time.perf_counter()
+        try:
+            async with session.post(url, json={"chunks": [chunk.chunk_hash for chunk in chunks]}) as response:
+                rtt = time.perf_counter() - request_time
+                if response.status == 503:
+                    return written    # Busy; the chunks are fetched piece by piece from whoever has a slot
+                if response.status != 200:
+                    raise Exception(f"Unexpected status {response.status}")
+                while True:
+                    try:
+                        header = await response.content.readexactly(BATCH_FRAME.size)
+                    except asyncio.IncompleteReadError as e:
+                        if e.partial:
+                            raise
+                        break
+                    index, size = BATCH_FRAME.unpack(header)
+                    if index >= len(chunks) or size != chunks[index].size:
+                        raise CorruptPieceError(f"Malformed batch from {peer}")
+                    chunk = chunks[index]
+                    reserved = await self.budget.acquire(size)
+                    try:
+                        data = await response.content.readexactly(size)
+                        BYTES_RECEIVED.labels(peer).inc(size)
+                        if not verify_hash(chunk.chunk_hash, data):
+                            await aprint(f"Rejected chunk {chunk.chunk_hash} from {peer}")
+                            await self.reject(peer, chunk)    # Fetched again piece by piece, from other peers
+                            continue
+                        await self.write_chunk_to_file(chunk.offset, data)
+                    finally:
+                        self.budget.release(reserved)
+                    self.mark_chunk(chunk)
+                    written.add(chunk.offset)
+            size = sum(chunk.size for chunk in chunks if chunk.offset in written)
+            self.peer_stats.record_transfer(peer, size, time.perf_counter() - request_time, rtt)
+        except Exception as e:
+            self.peer_stats.record_error(peer)
+            await aprint(f"Batch from {peer} failed: {e}")
+        return written
+
+    def has_local_copy(self, chunk):
+        return bool(self.file_store and self.file_store.get_chunk_locations(chunk.chunk_hash))
+
+    async def copy_local_chunks(self, chunks):
+        """Copy the chunks that already exist in the local file store. Returns the offsets of those copied."""
+        local_chunks = [chunk for chunk in chunks if self.has_local_copy(chunk)]
+        copied = await asyncio.gather(*(self.copy_local_chunk(chunk) for chunk in local_chunks))
+        for chunk, ok in zip(local_chunks, copied):
+            if ok:
+                self.mark_chunk(chunk)
+        return {chunk.offset for chunk, ok in zip(local_chunks, copied) if ok}
+
+    async def copy_local_chunk(self, chunk):
+        """Copy an identical chunk from the local file store, if there is one, verifying it on the way."""
+        file = self.file_store.get_file(chunk.chunk_hash) if self.file_store else None
+        if not file:
+            return False
+        local_chunk = file.chunks[chunk.chunk_hash]
+        version = self.file_store.file_paths.get(file.file_path, (None,))[0]
+        assembler = ChunkAssembler(self.pool, self.temp_file_path, chunk, self.budget)
+        try:
+            for offset in range(0, chunk.size, STREAM_BLOCK_SIZE):
+                size = min(STREAM_BLOCK_SIZE, chunk.size - offset)
+                reserved = await self.budget.acquire(size)
+                try:
+                    data = await self.pool.read(file.file_path, local_chunk.offset + offset, size, version)
+                    await self.write_chunk_to_file(chunk.offset + offset, data)
+                    await assembler.add(chunk.offset + offset, data)
+                finally:
+                    self.budget.release(reserved)
+        except OSError:
+            pass
+        return assembler.finish()
 
     async def write_chunk_to_file(self, offset, data):
-        async with aiofiles.open(self.temp_file_path, 'rb+') as file:
-            await file.seek(offset)
-            await file.write(data)
-            await file.flush()
+        await self.pool.write(self.temp_file_path, offset, data)
+
+    def mark_chunk(self, chunk):
+        """Record a written and verified chunk in the journal, and for peers to see through /have."""
+        index = self.chunk_positions[chunk.offset]
+        self.verified.add(index)
+        self.journal.record(index)
+        if self.partial:
+            self.partial.mark(index)
 
     async def download_file(self):
         start_time = time.time()
-        self.init_file()
+        chunks = [Chunk(**chunk_data) for chunk_data in self.chunks]
+        resumed = await self.resume(chunks)
+        self.verified.update(self.chunk_positions[offset] for offset in resumed)
+        if self.file_store:
+            self.partial = self.file_store.add_partial_file(self.file_data['file_hash'], self.temp_file_path, self.file_chunks,
+                                                            shared_metadata(self.file_data))
+            for offset in resumed:
+                self.partial.mark(self.chunk_positions[offset])
+        self.journal.start()
         failed_peers = []
         try:
             async with aiohttp.ClientSession(trust_env=True) as session:
-                download_coroutines = []
-                for chunk_data in self.chunks:
-                    chunk = Chunk(**chunk_data)
-                    download_coroutines.append(self.download_chunk(session, chunk))
-                results = await asyncio.gather(*download_coroutines)
-                for item in results:
-                    failed_peers.append(item)
-                file = File(self.temp_file_path, self.file_data['file_name'], self.file_data['chunk_size'])
+                written = resumed | await self.copy_local_chunks([chunk for chunk in chunks if chunk.offset not in resumed])
+                # Small chunks are cheaper to fetch many per request than piece by piece
+                small_chunks = [chunk for chunk in chunks if chunk.size <= BATCH_CHUNK_SIZE and chunk.offset not in written]
+                if len(small_chunks) > 1:
+                    written |= await self.download_batches(session, small_chunks)
+                scheduler = DownloadScheduler(self, session, [chunk for chunk in chunks if chunk.offset not in written],
+                                              self.max_in_flight, self.max_per_peer)
+                failed_peers = await scheduler.run()
+                await self.journal.close()    # Everything verified is journaled before the file is checked
+                if len(self.verified) < len(self.chunks):
+                    raise Exception(f"Missing {len(self.chunks) - len(self.verified)} chunks.")
+                self.pool.discard(self.temp_file_path)
+                if covers_file(sorted(self.chunks, key=lambda chunk: chunk['offset']), self.file_data['file_size']):
+                    # Every chunk matched its hash and together they cover the file, so the hash follows from the metadata
+                    file = await self.verified_file(session)
+                else:
+                    file = await asyncio.get_running_loop().run_in_executor(None, self.hashed_file)
                 if file.hash() == self.file_data['file_hash']:
+                    if self.file_store:
+                        self.file_store.remove_partial_file(self.file_data['file_hash'])    # Stop serving the temp file
                     os.rename(self.temp_file_path, self.file_path)
+                    self.journal.remove()
+                    if self.file_store:
+                        self.file_store.add_verified_file(self.file_path, file)
                     await aprint(f"Downloaded file: {self.file_data['file_name']}")
                     await aprint(f"Time elapsed: {time.time() - start_time:.2f} seconds")
                     return True, failed_peers
                 else:
-                    raise Exception("File hash mismatch. Missing chunks.")
+                    raise Exception("File hash mismatch.")
         except Exception as e:
             await aprint(f"Failed to download file: {self.file_data['file_name']}")
             await aprint(f"Error: {e}")
-            await aprint("Cleaning up...")
-            os.remove(self.temp_file_path)
+            self.pool.discard(self.temp_file_path)
+            await self.journal.close()
+            if len(self.journal.done) == len(self.file_chunks):
+                # Everything was journaled, so some chunk on disk is damaged; keep only those that still verify
+                valid = await self.chunks_on_disk([Chunk(**chunk_data) for chunk_data in self.file_chunks])
+                self.journal.create(self.chunk_positions[chunk.offset] for chunk in valid)
+                await self.journal.close()
+            if 0 < len(self.journal.done) < len(self.file_chunks):
+                await aprint(f"Kept {len(self.journal.done)} of {len(self.file_chunks)} chunks. Download again to resume.")
+            else:
+                # Nothing to keep, or every chunk verified and still the wrong file
+                await aprint("Cleaning up...")
+                self.journal.remove()
+                os.remove(self.temp_file_path)
+        finally:
+            await self.journal.close()
+            if self.file_store:
+                self.file_store.remove_partial_file(self.file_data['file_hash'])
         return False, failed_peers
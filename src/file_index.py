@@ -0,0 +1,74 @@
+import os
+import sqlite3
+from .utils import serialize, deserialize
+
+INDEX_FILE_NAME = '.file_index.sqlite'
+
+
+class FileIndex:
+    """Persistent index of file metadata keyed by path, size, mtime and inode."""
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self._connection = None
+
+    @property
+    def connection(self):
+        # Opened lazily so nodes can be pickled into worker processes before they start
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.index_path)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+                "config TEXT, file_hash TEXT, metadata BLOB)"
+            )
+            self._connection.execute("CREATE TABLE IF NOT EXISTS merkle_leaves (path TEXT PRIMARY KEY, leaves BLOB)")
+        return self._connection
+
+    @staticmethod
+    def stat_key(file_path):
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, file_path, key, config):
+        """Return the stored metadata for a path if its key and chunking config still match."""
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, config, metadata FROM files WHERE path = ?", (file_path,)
+        ).fetchone()
+        if row and tuple(row[:3]) == tuple(key) and row[3] == config:
+            return deserialize(row[4])
+        return None
+
+    def get_merkle_leaves(self, file_path):
+        row = self.connection.execute("SELECT leaves FROM merkle_leaves WHERE path = ?", (file_path,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, file_path, key, config, file_hash, metadata, merkle_leaves=None):
+        size, mtime_ns, inode = key
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (file_path, size, mtime_ns, inode, config, file_hash, serialize(metadata))
+        )
+        if merkle_leaves is not None:
+            self.connection.execute("INSERT OR REPLACE INTO merkle_leaves VALUES (?, ?)", (file_path, merkle_leaves))
+        else:
+            self.connection.execute("DELETE FROM merkle_leaves WHERE path = ?", (file_path,))
+
+    def remove(self, file_path):
+        self.connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+        self.connection.execute("DELETE FROM merkle_leaves WHERE path = ?", (file_path,))
+
+    def retain(self, file_paths):
+        """Drop entries for paths that are no longer present."""
+        stored = [row[0] for row in self.connection.execute("SELECT path FROM files")]
+        for file_path in stored:
+            if file_path not in file_paths:
+                self.remove(file_path)
+
+    def commit(self):
+        if self._connection is not None:
+            self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -1,71 +1,419 @@
 import aiohttp.web
 import aioconsole
 import asyncio
-from .file_store import FileStore, File
+import base64
+import os
+import struct
+import time
+from collections import Counter, OrderedDict
+from .bandwidth import BandwidthLimiter
+from . import metrics
+from .chunk_cache import CHUNK_CACHE_SIZE, ChunkCache
+from .disk_io import default_pool
+from .file_store import FileStore, File, PartialFile, full_bitfield
+from .hashing import new_hash, parse_hash
+from .merkle import MAX_PROOF_LEAVES
 
 DOWNLOAD_RATE = 1024 * 1024 * 10  # 10MB/s
+CHUNK_OFFSET_HEADER = 'X-Chunk-Offset'  # Offset of the chunk in the requester's file; makes Range chunk-relative
+RECENT_PATHS = 64
+BATCH_FRAME = struct.Struct('>IQ')    # Batch frame header: index of the chunk in the request, then its length
+MAX_BATCH_CHUNKS = 256
+MAX_BATCH_SIZE = 16 * 1024 * 1024
+MAX_UPLOADS = 64    # Chunk streams served at once; more are turned away with 503
+MAX_UPLOADS_PER_PEER = 16
+RETRY_AFTER = 1    # Seconds a turned-away peer is asked to wait
+MAX_DIGEST_SIZE = 16 * 1024 * 1024    # Largest range hashed for a /digest request
+DIGEST_BLOCK_SIZE = 256 * 1024
+
+BYTES_SERVED = metrics.counter('bytes_served_total', "Bytes of chunk data sent, by peer", ['peer'])
+REQUEST_SECONDS = metrics.histogram('request_duration_seconds', "Time to answer a file server request", ['route'])
+RANGE_BYTES = metrics.histogram('range_request_bytes', "Size of the byte ranges served", buckets=metrics.SIZE_BUCKETS)
+
+
+def chunk_covers(chunk, start, end):
+    return chunk.offset <= start and end < chunk.offset + chunk.size
+
 
 class FileServer:
-    def __init__(self, file_store: FileStore, host, port, download_rate=DOWNLOAD_RATE):
+    def __init__(self, file_store: FileStore, host, port, download_rate=DOWNLOAD_RATE, use_sendfile=True, burst=None,
+                 cache_size=CHUNK_CACHE_SIZE, max_uploads=MAX_UPLOADS, max_uploads_per_peer=MAX_UPLOADS_PER_PEER):
         self.file_store = file_store
         self.host = host
         self.port = port
-        self.server = aiohttp.web.Application()
+        self.server = aiohttp.web.Application(middlewares=[self.observe_request])
         self.create_routes()
-        self.download_rate = download_rate
+        self.limiter = BandwidthLimiter(download_rate, burst)    # Caps total upload across all streams
+        self.use_sendfile = use_sendfile
         self.runner = None
+        self.recent_paths = OrderedDict()    # Recently served files, most likely still in the page cache
+        self.disk_load = Counter()    # Maps devices to the number of reads in progress
+        self.devices = {}    # Maps file paths to devices
+        self.pool = default_pool    # Open files shared across requests
+        self.cache = ChunkCache(cache_size) if cache_size else None    # Hot chunks, served without touching disk
+        self.cache_loads = {}    # Maps chunk hashes to reads in progress, shared by concurrent misses
+        self.max_uploads = max_uploads
+        self.max_uploads_per_peer = max_uploads_per_peer
+        self.uploads = Counter()    # Maps peers to the number of streams being served to them
+        self.rejected_uploads = 0
 
     def create_routes(self):
         self.server.router.add_get('', self.handle_root_request)
         self.server.router.add_get('/chunks/{chunk_hash}', self.handle_chunk_request)
+        self.server.router.add_get('/manifest/{page_hash}', self.handle_manifest_request)
+        self.server.router.add_get('/proof/{merkle_root}', self.handle_proof_request)
+        self.server.router.add_post('/batch', self.handle_batch_request)
+        self.server.router.add_get('/metrics', self.handle_metrics_request)
+        self.server.router.add_get('/have/{file_hash}', self.handle_have_request)
+        self.server.router.add_get('/digest/{chunk_hash}', self.handle_digest_request)
+
+    @aiohttp.web.middleware
+    async def observe_request(self, request, handler):
+        start_time = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            route = request.match_info.route.resource
+            REQUEST_SECONDS.labels(route.canonical if route else 'unmatched').observe(time.perf_counter() - start_time)
 
     async def update_file_store(self, file_store):
         self.file_store = file_store
+        if self.cache:
+            self.cache.invalidate(file_store)
 
     async def handle_root_request(self, request):
         return aiohttp.web.Response(text="Online")
 
+    async def handle_metrics_request(self, request):
+        """Process-wide metrics plus this server's own state, in Prometheus text format."""
+        state = [
+            ('upload_limiter_wait_seconds_total', 'counter', "Time uploads spent waiting for bandwidth",
+             self.limiter.wait_time),
+            ('upload_rate_bytes', 'gauge', "Upload rate cap in bytes per second, 0 if unlimited",
+             self.limiter.rate or 0),
+            ('uploads_active', 'gauge', "Chunk streams being served", sum(self.uploads.values())),
+            ('uploads_rejected_total', 'counter', "Requests turned away for lack of an upload slot",
+             self.rejected_uploads),
+        ]
+        if self.cache:
+            state += [
+                ('chunk_cache_hits_total', 'counter', "Chunk reads served from memory", self.cache.hits),
+                ('chunk_cache_misses_total', 'counter', "Chunk reads that went to disk", self.cache.misses),
+                ('chunk_cache_bytes', 'gauge', "Bytes held in the chunk cache", self.cache.size),
+            ]
+        body = metrics.render() + ''.join(metrics.render_metric(name, kind, help, [('', (), (), value)])
+                                          for name, kind, help, value in state)
+        return aiohttp.web.Response(text=body, content_type='text/plain')
+
     async def handle_chunk_request(self, request):
         chunk_hash = request.match_info['chunk_hash']
         range_header = request.headers.get('Range')
 
-        file = self.file_store.get_file(chunk_hash)
-        if not file:
+        copies = self.file_store.get_chunk_copies(chunk_hash)
+        if not copies:
             return aiohttp.web.Response(status=404, text="Chunk not found")
-        chunk = file.chunks[chunk_hash]
-        if range_header:
-            start, end = map(int, range_header.split('=')[1].split('-'))
-            return await self.serve_content(request, file, start, end)
+        if not range_header:
+            file, chunk = self.pick_copy(copies)
+            return await self.serve_content(request, file, chunk.offset, chunk.offset + chunk.size - 1, chunk)
+        start, end = map(int, range_header.split('=')[1].split('-'))
+        if CHUNK_OFFSET_HEADER in request.headers:
+            chunk_offset = int(request.headers[CHUNK_OFFSET_HEADER])
+            if chunk_offset <= start and end < chunk_offset + copies[0][1].size:
+                # The range lies within the chunk, so any copy can serve it from its own offset
+                file, chunk = self.pick_copy(copies)
+                shift = chunk.offset - chunk_offset
+                return await self.serve_content(request, file, start + shift, end + shift, chunk)
+            # Bytes around the chunk are only known to match in a complete file holding it at the same offset
+            copies = [copy for copy in copies if copy[1].offset == chunk_offset and not isinstance(copy[0], PartialFile)]
         else:
-            return await self.serve_content(request, file, chunk.offset, chunk.offset + chunk.size - 1)
+            copies = [copy for copy in copies if chunk_covers(copy[1], start, end)]
+        if not copies:
+            return aiohttp.web.Response(status=416, text="Range extends past the chunk")
+        file, chunk = self.pick_copy(copies)
+        return await self.serve_content(request, file, start, end, chunk)
+
+    def pick_copy(self, copies):
+        """Pick the cheapest (file, chunk) copy: one served recently, then one on the least busy disk."""
+        if len(copies) == 1:
+            return copies[0]
+        return min(copies, key=lambda copy: (copy[0].file_path not in self.recent_paths,
+                                             self.disk_load[self.device(copy[0].file_path)]))
+
+    def device(self, file_path):
+        if file_path not in self.devices:
+            try:
+                self.devices[file_path] = os.stat(file_path).st_dev
+            except OSError:
+                return None
+        return self.devices[file_path]
+
+    def mark_recent(self, file_path):
+        self.recent_paths[file_path] = True
+        self.recent_paths.move_to_end(file_path)
+        if len(self.recent_paths) > RECENT_PATHS:
+            self.recent_paths.popitem(last=False)
+
+    async def handle_manifest_request(self, request):
+        page = self.file_store.get_manifest_page(request.match_info['page_hash'])
+        if not page:
+            return aiohttp.web.Response(status=404, text="Manifest page not found")
+        return aiohttp.web.Response(body=page, content_type='application/json')
 
-    async def serve_content(self, request, file: File, start, end):
-        end = min(end, file.file_size)
+    async def handle_proof_request(self, request):
+        """Return leaf hashes for blocks first..last and the proof linking them to the Merkle root."""
+        file = self.file_store.get_file(request.match_info['merkle_root'])
+        if not file or not file.merkle_tree:
+            return aiohttp.web.Response(status=404, text="Merkle tree not found")
+        try:
+            first, last = int(request.query['first']), int(request.query['last'])
+        except (KeyError, ValueError):
+            return aiohttp.web.Response(status=400, text="Invalid block range")
+        if not 0 <= first <= last < file.merkle_tree.count or last - first >= MAX_PROOF_LEAVES:
+            return aiohttp.web.Response(status=416, text="Block range not satisfiable")
+        return aiohttp.web.json_response(file.merkle_tree.range_proof(first, last))
+
+    async def handle_have_request(self, request):
+        """Report which chunks of a file this node holds, by index in file order.
+
+        The reply carries the chunk count, a sequence number and a base64 bitfield, most significant
+        bit first. With ?since=<seq> from an earlier reply about a partial file, it lists just the
+        indices gained since then under "have", if they are still remembered.
+        """
+        file_hash = request.match_info['file_hash']
+        file = self.file_store.files.get(file_hash)
+        if file:
+            count = len(file.chunks)
+            return aiohttp.web.json_response({"count": count, "seq": 0, "complete": True,
+                                              "bitfield": base64.b64encode(full_bitfield(count)).decode()})
+        partial = self.file_store.partial_files.get(file_hash)
+        if not partial:
+            return aiohttp.web.Response(status=404, text="File not found")
+        reply = {"count": len(partial.chunks), "seq": partial.seq, "complete": False}
+        if 'since' in request.query:
+            try:
+                changes = partial.changes_since(int(request.query['since']))
+            except ValueError:
+                return aiohttp.web.Response(status=400, text="Invalid sequence number")
+            if changes is not None:
+                return aiohttp.web.json_response(dict(reply, have=changes))
+        return aiohttp.web.json_response(dict(reply, bitfield=base64.b64encode(partial.bitfield).decode()))
+
+    async def handle_digest_request(self, request):
+        """Hash bytes start..end of a chunk with the chunk's algorithm, so a downloader can find a bad piece."""
+        chunk_hash = request.match_info['chunk_hash']
+        copies = self.file_store.get_chunk_copies(chunk_hash)
+        if not copies:
+            return aiohttp.web.Response(status=404, text="Chunk not found")
+        file, chunk = self.pick_copy(copies)
+        try:
+            start, end = int(request.query['start']), int(request.query['end'])
+        except (KeyError, ValueError):
+            return aiohttp.web.Response(status=400, text="Invalid range")
+        if not 0 <= start <= end < chunk.size or end - start >= MAX_DIGEST_SIZE:
+            return aiohttp.web.Response(status=400, text="Invalid range")
+        hash = new_hash(parse_hash(chunk_hash)[1])
+        version = self.file_version(file)
+        for offset in range(chunk.offset + start, chunk.offset + end + 1, DIGEST_BLOCK_SIZE):
+            size = min(DIGEST_BLOCK_SIZE, chunk.offset + end + 1 - offset)
+            hash.update(await self.pool.read(file.file_path, offset, size, version))
+        return aiohttp.web.json_response({"digest": hash.hexdigest()})
+
+    async def handle_batch_request(self, request):
+        """Stream several whole chunks in one response.
+
+        The body is a JSON list of chunk hashes under "chunks". Each chunk held here is sent as a
+        BATCH_FRAME header followed by its data; chunks not held here are left out.
+        """
+        try:
+            chunk_hashes = (await request.json())['chunks']
+        except (ValueError, KeyError, TypeError):
+            return aiohttp.web.Response(status=400, text="Invalid batch request")
+        if not isinstance(chunk_hashes, list) or not all(isinstance(chunk_hash, str) for chunk_hash in chunk_hashes):
+            return aiohttp.web.Response(status=400, text="Invalid batch request")
+        if len(chunk_hashes) > MAX_BATCH_CHUNKS:
+            return aiohttp.web.Response(status=413, text="Too many chunks")
+        frames = []
+        total_size = 0
+        for index, chunk_hash in enumerate(chunk_hashes):
+            copies = self.file_store.get_chunk_copies(chunk_hash)
+            if not copies:
+                continue
+            file, chunk = self.pick_copy(copies)
+            if total_size + chunk.size > MAX_BATCH_SIZE and frames:
+                break    # The requester asks again for whatever was left out
+            frames.append((index, file, chunk))
+            total_size += BATCH_FRAME.size + chunk.size
+        headers = {'Content-Type': 'application/octet-stream', 'Content-Length': str(total_size)}
+        if not self.take_upload_slot(request.remote):
+            return self.busy_response()
+        try:
+            response = aiohttp.web.StreamResponse(status=200, headers=headers)
+            await response.prepare(request)
+            for index, file, chunk in frames:
+                await response.write(BATCH_FRAME.pack(index, chunk.size))
+                await self.stream_range(request, response, file, chunk.offset, chunk.size, chunk)
+            await response.write_eof()
+            return response
+        except (ConnectionError, ConnectionResetError) as e:
+            return aiohttp.web.Response(status=500, text="Connection error")
+        finally:
+            self.release_upload_slot(request.remote)
+
+    async def serve_content(self, request, file: File, start, end, chunk=None):
+        end = min(end, file.file_size - 1)
         length = end - start + 1
         headers = {
             'Content-Type': 'application/octet-stream',
             'Content-Range': f'bytes {start}-{end}/{file.file_size}',
             'Content-Length': str(length)
         }
+        if not self.take_upload_slot(request.remote):
+            return self.busy_response()
+        RANGE_BYTES.observe(length)
         try:
             response = aiohttp.web.StreamResponse(status=206, headers=headers)
             await response.prepare(request)
-            with open(file.file_path, 'rb') as f:
-                f.seek(start)
-                while start <= end:
-                    chunk_size = min(1024 * 1024, end - start + 1)
-                    data = f.read(chunk_size)  # Read in small chunks
-                    await response.write(data)
-                    start += len(data)
-                    await asyncio.sleep(self.rate_limit(len(data)))
+            await self.stream_range(request, response, file, start, length, chunk)
             await response.write_eof()
             return response
         except (ConnectionError, ConnectionResetError) as e:
             return aiohttp.web.Response(status=500, text="Connection error")
+        finally:
+            self.release_upload_slot(request.remote)
+
+    def take_upload_slot(self, peer):
+        """Claim an upload slot for peer. Returns false if all slots, or all of the peer's, are in use."""
+        if sum(self.uploads.values()) >= self.max_uploads or self.uploads[peer] >= self.max_uploads_per_peer:
+            self.rejected_uploads += 1
+            return False
+        self.uploads[peer] += 1
+        return True
+
+    def release_upload_slot(self, peer):
+        self.uploads[peer] -= 1
+        if not self.uploads[peer]:
+            del self.uploads[peer]
+
+    def busy_response(self):
+        return aiohttp.web.Response(status=503, text="Upload slots full", headers={'Retry-After': str(RETRY_AFTER)})
+
+    async def stream_range(self, request, response, file: File, start, length, chunk=None):
+        """Write length bytes of the file from start to a prepared response, from the cache if it lies within chunk."""
+        if self.cache and chunk and chunk.offset <= start and start + length <= chunk.offset + chunk.size:
+            data = await self.read_chunk(file, chunk)
+            if data is not None:
+                await self.write_data(request, response, data[start - chunk.offset:start - chunk.offset + length])
+                return
+        device = self.device(file.file_path)
+        self.mark_recent(file.file_path)
+        self.disk_load[device] += 1
+        try:
+            async with self.pool.open(file.file_path, self.file_version(file), (start, length)) as f:
+                if self.use_sendfile and self.can_sendfile(request, response):
+                    sent = await self.send_range(request, f, start, length)
+                    start, length = start + sent, length - sent
+                if length > 0:
+                    await self.write_range(request, response, f, start, length)
+        finally:
+            self.disk_load[device] -= 1
+
+    def file_version(self, file: File):
+        """Stat key the store recorded for the file, so pooled descriptors are reopened when it changes."""
+        entry = self.file_store.file_paths.get(file.file_path)
+        return entry[0] if entry else None
+
+    def can_sendfile(self, request, response):
+        """Zero-copy sending needs a plain TCP transport and an uncompressed body."""
+        transport = request.transport
+        return (transport is not None and not response.compression
+                and transport.get_extra_info('sslcontext') is None)
+
+    async def send_range(self, request, f, offset, length):
+        """Send a file range with sendfile(2), in slices so the rate limit still applies. Returns the bytes sent.
+
+        The file is shared with other requests, so asyncio's seek-and-read fallback is not used; if
+        sendfile is unavailable the caller copies the rest instead.
+        """
+        loop = asyncio.get_running_loop()
+        total = 0
+        while total < length:
+            count = min(self.limiter.slice_size(), length - total)
+            await self.limiter.acquire(request.remote, count)
+            if request.transport is None or request.transport.is_closing():
+                raise ConnectionResetError("Peer went away")
+            try:
+                sent = await loop.sendfile(request.transport, f, offset + total, count, fallback=False)
+            except asyncio.SendfileNotAvailableError:
+                self.use_sendfile = False
+                break
+            if not sent:
+                break
+            total += sent
+            BYTES_SERVED.labels(request.remote).inc(sent)
+        return total
+
+    async def write_range(self, request, response, f, offset, length):
+        """Copying fallback; disk reads still run off the event loop."""
+        loop = asyncio.get_running_loop()
+        while length > 0:
+            count = min(self.limiter.slice_size(), length)
+            await self.limiter.acquire(request.remote, count)
+            data = await loop.run_in_executor(self.pool.executor, os.pread, f.fileno(), count, offset)
+            if not data:
+                break
+            await response.write(data)
+            offset += len(data)
+            length -= len(data)
+            BYTES_SERVED.labels(request.remote).inc(len(data))
+
+    async def write_data(self, request, response, data):
+        while data:
+            count = min(self.limiter.slice_size(), len(data))
+            await self.limiter.acquire(request.remote, count)
+            await response.write(data[:count])
+            BYTES_SERVED.labels(request.remote).inc(count)
+            data = data[count:]
+
+    async def read_chunk(self, file: File, chunk):
+        """Return the chunk's contents from the cache, reading it from disk once on a miss."""
+        load = self.cache_loads.get(chunk.chunk_hash)
+        if load is None:
+            data = self.cache.get(chunk.chunk_hash, self.file_store)
+            if data is not None:
+                return data
+            load = asyncio.ensure_future(self.load_chunk(file, chunk))
+            self.cache_loads[chunk.chunk_hash] = load
+            load.add_done_callback(lambda _: self.cache_loads.pop(chunk.chunk_hash, None))
+        else:
+            self.cache.hits += 1    # Joins a read already in progress
+        return await asyncio.shield(load)
+
+    async def load_chunk(self, file: File, chunk):
+        version = self.file_version(file)
+        if version is None:
+            return None
+        self.mark_recent(file.file_path)
+        device = self.device(file.file_path)
+        self.disk_load[device] += 1
+        try:
+            data = await self.pool.read(file.file_path, chunk.offset, chunk.size, version)
+        except OSError:
+            return None
+        finally:
+            self.disk_load[device] -= 1
+        if len(data) != chunk.size:
+            return None
+        self.cache.put(chunk.chunk_hash, data, file.file_path, version)
+        return memoryview(data)
 
+    @property
+    def download_rate(self):
+        return self.limiter.rate
 
-    def rate_limit(self, chunk_size):
-        return max(chunk_size/self.download_rate, 0)
+    @download_rate.setter
+    def download_rate(self, rate):
+        """Adjust the node-wide upload cap at runtime."""
+        self.limiter.set_rate(rate)
 
     async def run(self):
         self.runner = aiohttp.web.AppRunner(self.server)
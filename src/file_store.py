@@ -1,12 +1,36 @@
-import hashlib
+import asyncio
+import heapq
 import os
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from collections.abc import Mapping
+from itertools import repeat
+from . import metrics
+from .chunking import chunker_from_metadata
+from .hashing import default_hasher, hash_prefix, hash_string, DEFAULT_ALGORITHM
+from .manifest import build_manifest
+from .merkle import MerkleTree, MERKLE_BLOCK_SIZE
 from .utils import serialize
+from .file_index import FileIndex, INDEX_FILE_NAME
+from .file_watcher import DirectoryWatcher, FileEvent, is_shareable
 
 DEFAULT_CHUNK_SIZE = 8192
-MAX_CHUNKS = 30
+MAX_CHUNKS = 30    # Chunk size grows with the file until this many chunks...
+MAX_CHUNK_SIZE = 4 * 1024 * 1024    # ...or until it reaches this size, after which the chunk count grows instead
+# Rounding the grown size down leaves one short tail chunk, so files below the cap keep an inline chunk list
+MAX_INLINE_CHUNKS = MAX_CHUNKS + 1
+MERGE_SIZE = 4096    # Chunk index entries held in a dict before they are merged into its arrays
+HAVE_LOG_SIZE = 4096    # Chunk arrivals remembered for incremental have queries
+
+HASHED_BYTES = metrics.counter('hashed_bytes_total', "Bytes read and hashed when loading files")
+HASH_SECONDS = metrics.counter('hash_seconds_total', "Time spent hashing files; hashed_bytes_total over this is the throughput")
 
 
 class Chunk:
+    __slots__ = ('chunk_hash', 'offset', 'size', 'peers')
+
     def __init__(self, chunk_hash, offset, size, peers=None):
         self.chunk_hash = chunk_hash
         self.offset = offset
@@ -21,81 +45,590 @@ class Chunk:
         }
 
 
+def chunk_digest(chunk_hash):
+    """Return the binary digest of a chunk hash, or None if it is malformed."""
+    try:
+        return bytes.fromhex(chunk_hash.rsplit(':', 1)[-1])
+    except ValueError:
+        return None
+
+
+def fixed_chunk_size(file_size, chunk_size):
+    """Size of fixed chunks for a file: chunk_size, grown for large files so they keep few chunks."""
+    if file_size // chunk_size > MAX_CHUNKS:
+        return max(chunk_size, min(file_size // MAX_CHUNKS, MAX_CHUNK_SIZE))
+    return chunk_size
+
+
+def covers_file(chunks, file_size):
+    """Whether chunk records, in file order, cover [0, file_size) exactly."""
+    offset = 0
+    for chunk in chunks:
+        if chunk['offset'] != offset:
+            return False
+        offset += chunk['size']
+    return offset == file_size
+
+
+def digest_key(digest):
+    """Sort key of a binary digest: its first 8 bytes as an integer, so packed arrays can be bisected."""
+    return int.from_bytes(digest[:8], 'big')
+
+
+class ChunkTable(Mapping):
+    """Compact, read-only mapping of chunk hashes to Chunks, in file order.
+
+    Binary digests are packed into one buffer and offsets and sizes into arrays, with an
+    open-addressed table of positions for lookups, so no Python objects are kept per chunk. Chunk
+    objects are created on access. Unlike a dict, a digest that repeats within a file keeps every
+    entry: iteration, len and values() cover all of them in file order, and a lookup returns the first.
+    """
+    def __init__(self, entries, prefix='chunk:', digest_size=32):
+        self.prefix = prefix
+        self.digest_size = digest_size
+        digests = bytearray()
+        self.offsets = array('Q')
+        self.sizes = array('Q')
+        for digest, offset, size in entries:
+            digests += digest
+            self.offsets.append(offset)
+            self.sizes.append(size)
+        self.digests = bytes(digests)
+        # Positions plus one, at digest_key modulo the table size or the next free slot after it
+        self.slots = array('I', bytes(4 << (2 * len(self.offsets)).bit_length()))
+        self.mask = len(self.slots) - 1
+        for position in range(len(self.offsets)):
+            digest = self.digest(position)
+            if self.find(digest) < 0:
+                slot = digest_key(digest) & self.mask
+                while self.slots[slot]:
+                    slot = (slot + 1) & self.mask
+                self.slots[slot] = position + 1
+
+    def digest(self, position):
+        return self.digests[position * self.digest_size:(position + 1) * self.digest_size]
+
+    def find(self, digest):
+        """Return the first position of a binary digest, or -1."""
+        slots, size = self.slots, self.digest_size
+        slot = int.from_bytes(digest[:8], 'big') & self.mask
+        while slots[slot]:
+            position = slots[slot] - 1
+            if self.digests[position * size:(position + 1) * size] == digest:
+                return position
+            slot = (slot + 1) & self.mask
+        return -1
+
+    def _position(self, chunk_hash):
+        if not isinstance(chunk_hash, str) or not chunk_hash.startswith(self.prefix):
+            return -1
+        try:
+            digest = bytes.fromhex(chunk_hash[len(self.prefix):])
+        except ValueError:
+            return -1
+        return self.find(digest) if len(digest) == self.digest_size else -1
+
+    def chunk(self, position):
+        return Chunk(self.prefix + self.digest(position).hex(), self.offsets[position], self.sizes[position])
+
+    def __getitem__(self, chunk_hash):
+        position = self._position(chunk_hash)
+        if position < 0:
+            raise KeyError(chunk_hash)
+        return Chunk(chunk_hash, self.offsets[position], self.sizes[position])
+
+    def __contains__(self, chunk_hash):
+        return self._position(chunk_hash) >= 0
+
+    def __iter__(self):
+        for position in range(len(self.offsets)):
+            yield self.prefix + self.digest(position).hex()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def values(self):
+        return (self.chunk(position) for position in range(len(self.offsets)))
+
+    def digest_list(self):
+        return (self.digest(position) for position in range(len(self.offsets)))
+
+
+class ChunkIndex:
+    """Store-wide index of the files holding each chunk, kept in sorted packed arrays.
+
+    Chunks are indexed by digest_key, so a lookup can name a file that does not hold the chunk;
+    callers check the file's own ChunkTable. Chunks of files added since the last merge wait in a
+    small dict, and entries of removed files are dropped when the arrays are next rebuilt.
+    """
+    def __init__(self):
+        self.keys = array('Q')
+        self.ids = array('I')    # File ids, parallel to keys
+        self.pending = {}    # Maps keys of chunks added since the last merge to lists of file ids
+        self.pending_count = 0
+        self.stale_count = 0    # Entries in the arrays that belong to removed files
+        self.file_ids = {}    # Maps file hashes to ids
+        self.file_hashes = {}    # Maps ids of indexed files to their hashes
+        self.counts = {}    # Maps ids of indexed files to their number of entries
+        self.next_id = 0
+
+    def add(self, file_hash, digests):
+        if file_hash in self.file_ids:
+            return
+        file_id = self.next_id
+        self.next_id += 1
+        self.file_ids[file_hash] = file_id
+        self.file_hashes[file_id] = file_hash
+        keys = sorted({digest_key(digest) for digest in digests})
+        self.counts[file_id] = len(keys)
+        if len(keys) >= MERGE_SIZE:
+            self.merge(zip(keys, repeat(file_id)))    # Too many for the dict; merge them straight away
+            return
+        for key in keys:
+            self.pending.setdefault(key, []).append(file_id)
+        self.pending_count += len(keys)
+        if self.pending_count >= max(MERGE_SIZE, len(self.keys) // 4):
+            self.merge()
+
+    def remove(self, file_hash):
+        file_id = self.file_ids.pop(file_hash, None)
+        if file_id is None:
+            return
+        del self.file_hashes[file_id]
+        self.stale_count += self.counts.pop(file_id)
+        if self.stale_count >= max(MERGE_SIZE, len(self.keys) // 4):
+            self.merge()
+
+    def merge(self, extra=()):
+        """Rebuild the arrays with the pending entries and the sorted (key, file id) pairs of extra."""
+        pending = sorted((key, file_id) for key, file_ids in self.pending.items() for file_id in file_ids)
+        keys, ids = array('Q'), array('I')
+        for key, file_id in heapq.merge(zip(self.keys, self.ids), pending, extra):
+            if file_id in self.file_hashes:
+                keys.append(key)
+                ids.append(file_id)
+        self.keys, self.ids = keys, ids
+        self.pending = {}
+        self.pending_count = self.stale_count = 0
+
+    def get(self, digest):
+        """Return the hashes of files that may hold the chunk with the given binary digest."""
+        key = digest_key(digest)
+        i = bisect_left(self.keys, key)
+        file_ids = []
+        while i < len(self.keys) and self.keys[i] == key:
+            file_ids.append(self.ids[i])
+            i += 1
+        file_ids += self.pending.get(key, ())
+        return [self.file_hashes[file_id] for file_id in file_ids if file_id in self.file_hashes]
+
+
 class File:
-    """Class to represent a local file and its attributes."""
-    def __init__(self, file_path, file_name=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Class to represent a local file and its attributes.
+
+    Files are split into fixed-size chunks unless a content-defined chunker is given. Files with more
+    than MAX_INLINE_CHUNKS chunks list them in a separate manifest tree instead of the top-level metadata.
+    With merkle, a Merkle tree over MERKLE_BLOCK_SIZE blocks is built so pieces can be verified on their own.
+    Chunk and file hashes use hash_algorithm and name it in their prefix unless it is SHA-256.
+    """
+    def __init__(self, file_path, file_name=None, chunk_size=DEFAULT_CHUNK_SIZE, chunker=None, merkle=False,
+                 hash_algorithm=DEFAULT_ALGORITHM):
         self.file_path = file_path
         self.file_name = file_name if file_name else os.path.basename(file_path)
         self.file_size = os.path.getsize(file_path)
-        if self.file_size // chunk_size > MAX_CHUNKS:
-            self.chunk_size = self.file_size // MAX_CHUNKS
-        else:
-            self.chunk_size = chunk_size
+        self.chunker = chunker
+        self.hash_algorithm = hash_algorithm
+        self.chunk_size = chunker.avg_size if chunker else fixed_chunk_size(self.file_size, chunk_size)
         self.chunks = self._chunk_file()
+        self.merkle_tree = MerkleTree.from_file(file_path, self.file_size, default_hasher) if merkle else None
+        self._manifest = None
 
-    def metadata(self, serialized=False):
+    def metadata(self, serialized=False, full=False):
+        """Top-level file record. With full, chunks are always listed inline rather than by manifest."""
         data = {
             "file_name": self.file_name,
             "file_size": self.file_size,
             "chunk_size": self.chunk_size,
-            "chunks": [{**chunk.metadata()} for chunk in self.chunks.values()],
         }
+        if full or not self.has_manifest():
+            data["chunks"] = [{**chunk.metadata()} for chunk in self.chunks.values()]
+        else:
+            data["chunk_count"] = len(self.chunks)
+            data["manifest"] = self.manifest()[0]
+        if self.chunker:
+            data["chunking"] = self.chunker.metadata()
+        if self.hash_algorithm != DEFAULT_ALGORITHM:
+            data["hash_algorithm"] = self.hash_algorithm
+        if self.merkle_tree:
+            data["merkle_root"] = self.merkle_tree.root()
+            data["merkle_block_size"] = MERKLE_BLOCK_SIZE
         return serialize(data) if serialized else data
 
+    @classmethod
+    def from_metadata(cls, file_path, metadata, merkle_leaves=None):
+        """Rebuild a file from previously computed metadata without reading its contents."""
+        file = cls.__new__(cls)
+        file.file_path = file_path
+        file.file_name = metadata['file_name']
+        file.file_size = metadata['file_size']
+        file.chunk_size = metadata['chunk_size']
+        file.chunker = chunker_from_metadata(metadata)
+        file.hash_algorithm = metadata.get('hash_algorithm', DEFAULT_ALGORITHM)
+        file.chunks = ChunkTable(((chunk_digest(chunk['chunk_hash']), chunk['offset'], chunk['size'])
+                                  for chunk in metadata['chunks']), hash_prefix('chunk', file.hash_algorithm))
+        file.merkle_tree = MerkleTree(merkle_leaves) if merkle_leaves is not None else None
+        file._manifest = None
+        return file
+
+    def has_manifest(self):
+        return len(self.chunks) > MAX_INLINE_CHUNKS
+
+    def manifest(self):
+        """Return the manifest root hash and pages for this file's chunk list."""
+        if self._manifest is None:
+            self._manifest = build_manifest([chunk.metadata() for chunk in self.chunks.values()])
+        return self._manifest
+
     def hash(self):
-        return f"file:{hashlib.sha256(self.metadata(serialized=True)).hexdigest()}"
+        return hash_string('file', self.metadata(serialized=True), self.hash_algorithm)
 
     def has_chunk(self, chunk_hash):
         return chunk_hash in self.chunks
 
     def _chunk_file(self):
-        """Chunk the file into smaller pieces."""
-        chunks = {}
-        offset = 0
-        with open(self.file_path, "rb") as f:
-            while chunk := f.read(self.chunk_size):
-                chunk_hash = f"chunk:{hashlib.sha256(chunk).hexdigest()}"
-                chunks[chunk_hash] = Chunk(chunk_hash, offset, len(chunk))
-                offset += len(chunk)
-        return chunks
+        """Chunk the file into smaller pieces, hashing them in parallel."""
+        if self.chunker:
+            ranges = self.chunker.ranges(self.file_path)
+        else:
+            ranges = ((offset, min(self.chunk_size, self.file_size - offset))
+                      for offset in range(0, self.file_size, self.chunk_size))
+        digests = default_hasher.hash_ranges(self.file_path, ranges, self.hash_algorithm)
+        return ChunkTable(((digest, offset, size) for offset, size, digest in digests),
+                          hash_prefix('chunk', self.hash_algorithm))
 
     def __repr__(self):
         return f'File("{self.file_name}", {self.file_size} bytes, {len(self.chunks)} chunks): {self.hash()}'
 
 
+def full_bitfield(count):
+    """Bitfield with the first count bits set, most significant bit first."""
+    bitfield = bytearray(b'\xff' * (count // 8))
+    if count % 8:
+        bitfield.append((0xff << (8 - count % 8)) & 0xff)
+    return bitfield
+
+
+def bitfield_indices(bitfield, count):
+    return [i for i in range(count) if bitfield[i >> 3] & (0x80 >> (i & 7))]
+
+
+class PartialFile:
+    """A file being downloaded: its chunks in file order and which of them are written and verified.
+
+    Every chunk that arrives bumps seq, and the most recent arrivals are kept so peers can ask
+    for just the chunks gained since the seq they last saw. Chunks that arrived are served to
+    other peers while the download goes on.
+    """
+    def __init__(self, file_hash, file_path, chunks, metadata=None):
+        self.file_hash = file_hash
+        self.file_path = file_path
+        self.chunks = chunks
+        self.file_size = max((chunk['offset'] + chunk['size'] for chunk in chunks), default=0)
+        self.metadata = metadata    # File record to give peers asking for the file
+        self.bitfield = bytearray((len(chunks) + 7) // 8)
+        self.seq = 0
+        self.log = deque(maxlen=HAVE_LOG_SIZE)    # Chunk indices in order of arrival, ending at seq
+        self.available = {}    # Maps hashes of the chunks that arrived to Chunks
+
+    def has(self, index):
+        return bool(self.bitfield[index >> 3] & (0x80 >> (index & 7)))
+
+    def mark(self, index):
+        if not self.has(index):
+            self.bitfield[index >> 3] |= 0x80 >> (index & 7)
+            self.seq += 1
+            self.log.append(index)
+            chunk = self.chunks[index]
+            self.available[chunk['chunk_hash']] = Chunk(chunk['chunk_hash'], chunk['offset'], chunk['size'])
+
+    def changes_since(self, seq):
+        """Indices of the chunks gained after seq, or None if they are no longer all remembered."""
+        if not self.seq - len(self.log) <= seq <= self.seq:
+            return None
+        return list(self.log)[len(self.log) - (self.seq - seq):]
+
+
 class FileStore:
     """Class to read files in a directory and load them into memory."""
-    def __init__(self, base_directory, chunk_size=DEFAULT_CHUNK_SIZE):
+    def __init__(self, base_directory, chunk_size=DEFAULT_CHUNK_SIZE, use_index=True, chunker=None, merkle=False,
+                 hash_algorithm=DEFAULT_ALGORITHM):
         self.base_directory = base_directory
         self.chunk_size = chunk_size
+        self.chunker = chunker    # Optional ContentDefinedChunker used instead of fixed-size chunks
+        self.merkle = merkle    # Build Merkle trees so downloaders can verify individual pieces
+        self.hash_algorithm = hash_algorithm    # Algorithm for hashes of local files; remote hashes name their own
         self.files = {}    # Maps file hashes to file objects
-        self.file_chunks = {}    # Maps chunk hashes to file hashes
+        self.chunk_index = ChunkIndex()    # Finds the files holding a chunk
+        self.file_paths = {}    # Maps file paths to (stat key, file hash)
+        self.manifest_pages = {}    # Maps manifest page hashes to file hashes
+        self.merkle_roots = {}    # Maps Merkle roots to file hashes
+        self.partial_files = {}    # Maps file hashes to downloads in progress
+        self.index = FileIndex(os.path.join(base_directory, INDEX_FILE_NAME)) if use_index else None
+        self.index_pruned = False
 
     def get_file(self, hash):
         if hash.startswith('file:'):
             return self.files.get(hash)
         if hash.startswith('chunk:'):
-            return self.files.get(self.file_chunks.get(hash))
+            locations = self.get_chunk_locations(hash)
+            return locations[0] if locations else None
+        if hash.startswith('merkle:'):
+            return self.files.get(self.merkle_roots.get(hash))
         return None
 
+    def get_chunk_locations(self, chunk_hash):
+        """Return every file that holds the chunk."""
+        return [file for file in self._candidate_files(chunk_hash) if chunk_hash in file.chunks]
+
+    def get_chunk_copies(self, chunk_hash):
+        """Return (file, chunk) for every copy of the chunk, including those in downloads in progress."""
+        copies = []
+        for file in self._candidate_files(chunk_hash):
+            chunk = file.chunks.get(chunk_hash)
+            if chunk:
+                copies.append((file, chunk))
+        copies += [(partial, partial.available[chunk_hash]) for partial in list(self.partial_files.values())
+                   if chunk_hash in partial.available]
+        return copies
+
+    def _candidate_files(self, chunk_hash):
+        digest = chunk_digest(chunk_hash)
+        if not digest:
+            return []
+        files = (self.files.get(file_hash) for file_hash in self.chunk_index.get(digest))
+        return [file for file in files if file]
+
+    def add_partial_file(self, file_hash, file_path, chunks, metadata=None):
+        partial = PartialFile(file_hash, file_path, chunks, metadata)
+        self.partial_files[file_hash] = partial
+        return partial
+
+    def remove_partial_file(self, file_hash):
+        self.partial_files.pop(file_hash, None)
+
+    def add_verified_file(self, file_path, file):
+        """Share a file whose chunks were already verified, such as a finished download, without hashing it.
+
+        It is also indexed if this store would have chunked it the same way, so later loads reuse it.
+        """
+        file_path = file.file_path = self._store_path(file_path)
+        key = FileIndex.stat_key(file_path)
+        if file_path in self.file_paths:
+            self._remove_path(file_path)
+        if self._chunks_like(file):
+            self._index_file(file_path, key, file)
+        if self.index:
+            self.index.commit()
+        return self._add_file(file_path, key, file)
+
+    def _store_path(self, file_path):
+        """Spell a path in the share directory the way scans and directory events do, so it gets one entry."""
+        relative = os.path.relpath(file_path, self.base_directory)
+        return file_path if relative.startswith(os.pardir) else os.path.join(self.base_directory, relative)
+
+    def _chunks_like(self, file):
+        """Whether hashing the file here would give the metadata it already has."""
+        if file.hash_algorithm != self.hash_algorithm or bool(file.merkle_tree) != self.merkle:
+            return False
+        if self.chunker or file.chunker:
+            return bool(self.chunker and file.chunker) and self.chunker.config() == file.chunker.config()
+        return file.chunk_size == fixed_chunk_size(file.file_size, self.chunk_size)
+
+    def get_manifest_page(self, page_hash):
+        file = self.files.get(self.manifest_pages.get(page_hash))
+        return file.manifest()[1].get(page_hash) if file else None
+
+    def index_config(self):
+        """Chunking parameters that must match for an indexed entry to be reused."""
+        config = self.chunker.config() if self.chunker else f"fixed:{self.chunk_size}:{MAX_CHUNK_SIZE}"
+        config = f"{self.hash_algorithm}:{config}"
+        return f"{config}:merkle:{MERKLE_BLOCK_SIZE}" if self.merkle else config
+
     def load_files(self):
         """Load files from local directory. Returns true if new files are found."""
         found_new_files = False
-        files = set()
+        paths = self._scan()
+        for file_path, key in self._changed_paths(paths):
+            file = self._indexed_file(file_path, key) or self._hash_file(file_path, key)
+            found_new_files |= self._add_file(file_path, key, file)
+        self._finish_scan(paths)
+        return found_new_files
+
+    async def load_files_async(self):
+        """Like load_files, but scans and hashes off the event loop and registers each file as it completes."""
+        loop = asyncio.get_running_loop()
+        found_new_files = False
+        paths = await loop.run_in_executor(None, self._scan)
+        for file_path, key in self._changed_paths(paths):
+            file = self._indexed_file(file_path, key)
+            if not file:
+                try:
+                    file = await loop.run_in_executor(None, self._new_file, file_path)
+                except OSError:
+                    paths.pop(file_path)    # Removed or unreadable since the scan
+                    continue
+                self._index_file(file_path, key, file)
+            found_new_files |= self._add_file(file_path, key, file)
+        self._finish_scan(paths)
+        return found_new_files
+
+    async def watch(self, poll_interval=1):
+        """Load files, then keep them up to date from directory events instead of rescanning.
+
+        Yields after the initial load and after each batch of events, with True when new files appeared.
+        Uses inotify where available and falls back to polling every poll_interval seconds.
+        """
+        watcher = DirectoryWatcher(self.base_directory, poll_interval)
+        watcher.start()    # Start before the initial scan so no change is missed
+        yield await self.load_files_async()
+        async for events in watcher.events():
+            yield await self.apply_events(events)
+
+    async def apply_events(self, events):
+        """Update only the files affected by the given directory events. Returns true if new files are found."""
+        found_new_files = False
+        for event in events:
+            if event.kind == FileEvent.RESCAN:
+                found_new_files |= await self.load_files_async()
+            elif event.kind == FileEvent.DELETED:
+                if event.file_path in self.file_paths:
+                    self._remove_path(event.file_path)
+            else:
+                if event.kind == FileEvent.RENAMED and event.old_path in self.file_paths:
+                    found_new_files |= self._rename_path(event.old_path, event.file_path)
+                found_new_files |= await self.update_path(event.file_path)
+        if self.index:
+            self.index.commit()
+        return found_new_files
+
+    async def update_path(self, file_path):
+        """(Re)load a single file if it is new or changed. Returns true if it is a new file."""
+        try:
+            key = FileIndex.stat_key(file_path)
+        except FileNotFoundError:
+            if file_path in self.file_paths:
+                self._remove_path(file_path)
+            return False
+        for file_path, key in self._changed_paths({file_path: key}):
+            file = self._indexed_file(file_path, key)
+            if not file:
+                try:
+                    file = await asyncio.get_running_loop().run_in_executor(None, self._new_file, file_path)
+                except OSError:
+                    return False
+                self._index_file(file_path, key, file)
+            return self._add_file(file_path, key, file)
+        return False
+
+    def _scan(self):
+        """Return the stat key of every shareable file in the directory."""
+        paths = {}
         for f in os.listdir(self.base_directory):
             file_path = os.path.join(self.base_directory, f)
-            if os.path.isfile(file_path) and not f.startswith('.') and not f.endswith('.download'):
-                file = File(file_path=file_path, chunk_size=self.chunk_size)
-                file_hash = file.hash()
-                files.add(file_hash)
-                if file_hash not in self.files:
-                    self.files[file_hash] = file
-                    for chunk_hash in file.chunks:
-                        self.file_chunks[chunk_hash] = file_hash
-                    found_new_files = True
+            if os.path.isfile(file_path) and is_shareable(f):
+                paths[file_path] = FileIndex.stat_key(file_path)
+        return paths
+
+    def _changed_paths(self, paths):
+        """Yield paths that are new or whose key changed, dropping their stale entries first."""
+        for file_path, key in list(paths.items()):
+            known = self.file_paths.get(file_path)
+            if known and known[0] == key:
+                continue
+            if known:
+                self._remove_path(file_path)
+            yield file_path, key
+
+    def _finish_scan(self, paths):
         # Remove files that are no longer present
-        previous_files = set(self.files.keys())
-        for file_hash in previous_files:
-            if file_hash not in files:
-                del self.files[file_hash]
-        return found_new_files
+        for file_path in set(self.file_paths) - set(paths):
+            self._remove_path(file_path)
+        if self.index:
+            if not self.index_pruned:
+                self.index.retain(paths)
+                self.index_pruned = True
+            self.index.commit()
+
+    def _indexed_file(self, file_path, key):
+        """Return the file rebuilt from the index if its key is unchanged."""
+        if self.index:
+            metadata = self.index.get(file_path, key, self.index_config())
+            # Entries written when repeated chunks were listed once leave gaps; those files are hashed again
+            if metadata and covers_file(metadata['chunks'], metadata['file_size']):
+                return File.from_metadata(file_path, metadata, self.index.get_merkle_leaves(file_path))
+        return None
+
+    def _new_file(self, file_path):
+        start_time = time.perf_counter()
+        file = File(file_path=file_path, chunk_size=self.chunk_size, chunker=self.chunker, merkle=self.merkle,
+                    hash_algorithm=self.hash_algorithm)
+        HASH_SECONDS.inc(time.perf_counter() - start_time)
+        HASHED_BYTES.inc(file.file_size)
+        return file
+
+    def _hash_file(self, file_path, key):
+        file = self._new_file(file_path)
+        self._index_file(file_path, key, file)
+        return file
+
+    def _index_file(self, file_path, key, file):
+        if self.index:
+            self.index.put(file_path, key, self.index_config(), file.hash(), file.metadata(full=True),
+                           file.merkle_tree.leaves if file.merkle_tree else None)
+
+    def _add_file(self, file_path, key, file):
+        file_hash = file.hash()
+        self.file_paths[file_path] = (key, file_hash)
+        if file_hash in self.files:
+            return False
+        self.files[file_hash] = file
+        self.chunk_index.add(file_hash, file.chunks.digest_list())
+        if file.has_manifest():
+            for page_hash in file.manifest()[1]:
+                self.manifest_pages[page_hash] = file_hash
+        if file.merkle_tree:
+            self.merkle_roots[file.merkle_tree.root()] = file_hash
+        return True
+
+    def _rename_path(self, old_path, file_path):
+        """Move an entry to its new path, reusing its chunk table instead of rehashing the contents."""
+        key, file_hash = self.file_paths[old_path]
+        old_file = self.files[file_hash]
+        metadata = {**old_file.metadata(full=True), 'file_name': os.path.basename(file_path)}
+        self._remove_path(old_path)
+        if file_path in self.file_paths:
+            self._remove_path(file_path)    # Moved over a shared file, which is gone now
+        file = File.from_metadata(file_path, metadata, old_file.merkle_tree.leaves if old_file.merkle_tree else None)
+        self._index_file(file_path, key, file)
+        return self._add_file(file_path, key, file)
+
+    def _remove_path(self, file_path):
+        _, file_hash = self.file_paths.pop(file_path)
+        if self.index:
+            self.index.remove(file_path)
+        file = self.files.get(file_hash)
+        if not file or file.file_path != file_path:
+            return
+        # Keep the file if an identical copy is still present under another path
+        for other_path, (_, other_hash) in self.file_paths.items():
+            if other_hash == file_hash:
+                file.file_path = other_path
+                return
+        del self.files[file_hash]
+        self.chunk_index.remove(file_hash)
+        if file.has_manifest():
+            for page_hash in file.manifest()[1]:
+                if self.manifest_pages.get(page_hash) == file_hash:
+                    del self.manifest_pages[page_hash]
+        if file.merkle_tree and self.merkle_roots.get(file.merkle_tree.root()) == file_hash:
+            del self.merkle_roots[file.merkle_tree.root()]
@@ -0,0 +1,199 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+from .download_journal import JOURNAL_SUFFIX
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+SETTLE_DELAY = 0.01   # Delay for events that mark a file as complete (close after write, move, delete)
+DEBOUNCE_DELAY = 1.0   # Quiet period before a file that is still open for writing is picked up
+
+
+class FileEvent:
+    ADDED = 'add'
+    MODIFIED = 'modify'
+    DELETED = 'delete'
+    RENAMED = 'rename'
+    RESCAN = 'rescan'
+
+    def __init__(self, kind, file_path=None, old_path=None):
+        self.kind = kind
+        self.file_path = file_path
+        self.old_path = old_path
+
+    def __repr__(self):
+        if self.kind == FileEvent.RENAMED:
+            return f'FileEvent({self.kind}, {self.old_path} -> {self.file_path})'
+        return f'FileEvent({self.kind}, {self.file_path})'
+
+
+def is_shareable(file_name):
+    return not file_name.startswith('.') and not file_name.endswith(('.download', '.download' + JOURNAL_SUFFIX))
+
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc if hasattr(libc, 'inotify_init1') else None
+    except OSError:
+        return None
+
+
+class DirectoryWatcher:
+    """Watches a directory for file changes using inotify, falling back to polling."""
+    def __init__(self, directory, poll_interval=1, debounce=DEBOUNCE_DELAY):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.queue = None
+        self.fd = None
+        self.pending = {}    # Maps file names to (event, timer handle) awaiting debounce
+        self.moved_from = {}    # Maps rename cookies to the old file name
+        self.snapshot = None    # Polling mode: maps file names to stat keys
+        self.unsettled = {}    # Polling mode: maps changed file names to the key seen on the last poll
+
+    def start(self):
+        """Start watching. Uses inotify when available; returns True if it did."""
+        self.queue = asyncio.Queue()
+        libc = _load_inotify()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK) >= 0:
+                self.fd = fd
+                asyncio.get_running_loop().add_reader(fd, self._read_events)
+                return True
+            if fd >= 0:
+                os.close(fd)
+        self.snapshot = self._stat_directory()
+        return False
+
+    def stop(self):
+        for _, handle in self.pending.values():
+            handle.cancel()
+        self.pending.clear()
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    async def events(self):
+        """Yield batches of FileEvents as they become available."""
+        if self.queue is None:
+            self.start()
+        try:
+            while True:
+                if self.fd is None:
+                    await asyncio.sleep(self.poll_interval)
+                    events = self._poll()
+                    if events:
+                        yield events
+                    continue
+                events = [await self.queue.get()]
+                while not self.queue.empty():
+                    events.append(self.queue.get_nowait())
+                yield events
+        finally:
+            self.stop()
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            _, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            name = os.fsdecode(name)
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                self.queue.put_nowait(FileEvent(FileEvent.RESCAN))
+                continue
+            if mask & (IN_ISDIR | IN_IGNORED) or not name:
+                continue
+            if mask & IN_MOVED_FROM:
+                self.moved_from[cookie] = name
+                self._schedule(name, FileEvent.DELETED, SETTLE_DELAY)
+            elif mask & IN_MOVED_TO:
+                old_name = self.moved_from.pop(cookie, None)
+                if old_name in self.pending and is_shareable(name):
+                    self.pending.pop(old_name)[1].cancel()
+                    self._schedule(name, FileEvent.RENAMED, SETTLE_DELAY, old_name)
+                else:
+                    self._schedule(name, FileEvent.ADDED, SETTLE_DELAY)
+            elif mask & IN_DELETE:
+                self._schedule(name, FileEvent.DELETED, SETTLE_DELAY)
+            elif mask & IN_CLOSE_WRITE:
+                self._schedule(name, FileEvent.MODIFIED, SETTLE_DELAY)
+            elif mask & (IN_CREATE | IN_MODIFY):
+                # Still being written; wait for it to be closed or to go quiet
+                self._schedule(name, FileEvent.MODIFIED, self.debounce)
+
+    def _schedule(self, name, kind, delay, old_name=None):
+        previous = self.pending.pop(name, None)
+        if previous:
+            previous[1].cancel()
+        if not is_shareable(name):
+            return
+        event = FileEvent(kind, os.path.join(self.directory, name),
+                          os.path.join(self.directory, old_name) if old_name else None)
+        handle = asyncio.get_running_loop().call_later(delay, self._emit, name)
+        self.pending[name] = (event, handle)
+
+    def _emit(self, name):
+        event, _ = self.pending.pop(name)
+        self.moved_from = {cookie: old for cookie, old in self.moved_from.items() if old != name}
+        self.queue.put_nowait(event)
+
+    def _stat_directory(self):
+        snapshot = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and is_shareable(entry.name):
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return snapshot
+
+    def _poll(self):
+        """Diff the directory against the last snapshot. Files that are still changing are left for the next poll."""
+        current = self._stat_directory()
+        previous = self.snapshot
+        events = []
+        removed = {key[2]: name for name, key in previous.items() if name not in current}
+        for name, key in current.items():
+            if previous.get(name) == key:
+                continue
+            if name not in previous and key[2] in removed:
+                old_name = removed.pop(key[2])
+                events.append(FileEvent(FileEvent.RENAMED, os.path.join(self.directory, name),
+                                        os.path.join(self.directory, old_name)))
+            elif self.unsettled.pop(name, None) == key:
+                events.append(FileEvent(FileEvent.ADDED if name not in previous else FileEvent.MODIFIED,
+                                        os.path.join(self.directory, name)))
+            else:
+                self.unsettled[name] = key
+                current[name] = previous.get(name)
+        self.unsettled = {name: key for name, key in self.unsettled.items() if name in current}
+        for name in removed.values():
+            events.append(FileEvent(FileEvent.DELETED, os.path.join(self.directory, name)))
+        self.snapshot = {name: key for name, key in current.items() if key is not None}
+        return events
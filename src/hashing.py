@@ -0,0 +1,164 @@
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import blake3
+except ImportError:  # blake3 is optional
+    blake3 = None
+
+HASH_WORKERS = os.cpu_count() or 1
+BATCH_SIZE = 4 * 1024 * 1024  # Minimum number of bytes handed to a worker per job
+DEFAULT_ALGORITHM = 'sha256'
+
+# Constructors for the supported algorithms; every one yields a 32-byte digest
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda data=b'': hashlib.blake2b(data, digest_size=32),
+}
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM, data=b''):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+    return HASH_ALGORITHMS[algorithm](data)
+
+
+def hash_prefix(kind, algorithm=DEFAULT_ALGORITHM):
+    """Prefix for a hash string, e.g. chunk:blake2b:. SHA-256 keeps the bare chunk:/file: form so existing hashes stay valid."""
+    return f"{kind}:" if algorithm == DEFAULT_ALGORITHM else f"{kind}:{algorithm}:"
+
+
+def parse_hash(value):
+    """Split a hash string into (kind, algorithm, hexdigest)."""
+    parts = value.split(':')
+    if len(parts) == 2:
+        return parts[0], DEFAULT_ALGORITHM, parts[1]
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    raise ValueError(f"Malformed hash: {value}")
+
+
+def hash_string(kind, data, algorithm=DEFAULT_ALGORITHM):
+    return hash_prefix(kind, algorithm) + new_hash(algorithm, data).hexdigest()
+
+
+def verify_hash(value, data):
+    """Check data against a self-describing hash string, using whichever algorithm it names."""
+    try:
+        kind, algorithm, hexdigest = parse_hash(value)
+        return new_hash(algorithm, data).hexdigest() == hexdigest
+    except ValueError:
+        return False
+
+
+def read_into(fd, view, offset):
+    """Fill view with the file's bytes from offset. A file that ends early, e.g. truncated while it is read, raises OSError."""
+    filled = 0
+    while filled < len(view):
+        with view[filled:] as rest:
+            count = os.preadv(fd, [rest], offset + filled)
+        if not count:
+            raise OSError(f"File ended at {offset + filled} bytes while being read")
+        filled += count
+
+
+class ChunkHasher:
+    """Hashes byte ranges of a file in parallel on a thread pool; hashlib releases the GIL.
+
+    Each worker reads into its own batch_size buffer with pread rather than mapping the file,
+    so a file truncated mid-hash raises OSError instead of faulting the process.
+    """
+    def __init__(self, workers=HASH_WORKERS, max_in_flight=None, batch_size=BATCH_SIZE):
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers * 2
+        self.batch_size = batch_size
+        self._executor = None
+        self._local = threading.local()    # Per-worker read buffer
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hasher')
+        return self._executor
+
+    def _batches(self, ranges):
+        """Group small ranges so each job carries at least batch_size bytes."""
+        batch, batch_bytes = [], 0
+        for offset, size in ranges:
+            batch.append((offset, size))
+            batch_bytes += size
+            if batch_bytes >= self.batch_size:
+                yield batch
+                batch, batch_bytes = [], 0
+        if batch:
+            yield batch
+
+    def _buffer(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray(self.batch_size)
+        return buffer
+
+    def _hash_batch(self, fd, batch, algorithm):
+        """Hash ranges of a batch, reading each contiguous run that fits the buffer at once."""
+        constructor = HASH_ALGORITHMS[algorithm]
+        digests = []
+        with memoryview(self._buffer()) as view:
+            i = 0
+            while i < len(batch):
+                start = end = batch[i][0]
+                j = i
+                while j < len(batch) and batch[j][0] == end and end + batch[j][1] - start <= len(view):
+                    end += batch[j][1]
+                    j += 1
+                if j == i:
+                    # Larger than the buffer; hash it a buffer at a time
+                    offset, size = batch[i]
+                    hash = constructor()
+                    for position in range(offset, offset + size, len(view)):
+                        with view[:min(len(view), offset + size - position)] as data:
+                            read_into(fd, data, position)
+                            hash.update(data)
+                    digests.append(hash.digest())
+                    i += 1
+                    continue
+                with view[:end - start] as run:
+                    read_into(fd, run, start)
+                    for offset, size in batch[i:j]:
+                        with run[offset - start:offset - start + size] as data:
+                            digests.append(constructor(data).digest())
+                i = j
+        return digests
+
+    def hash_ranges(self, file_path, ranges, algorithm=DEFAULT_ALGORITHM):
+        """Yield (offset, size, digest) for each range in order, with a bounded number of jobs in flight."""
+        with open(file_path, 'rb') as f:
+            pending = deque()
+            try:
+                for batch in self._batches(ranges):
+                    pending.append((batch, self.executor.submit(self._hash_batch, f.fileno(), batch, algorithm)))
+                    if len(pending) >= self.max_in_flight:
+                        batch, future = pending.popleft()
+                        yield from ((o, s, d) for (o, s), d in zip(batch, future.result()))
+                while pending:
+                    batch, future = pending.popleft()
+                    yield from ((o, s, d) for (o, s), d in zip(batch, future.result()))
+            finally:
+                # Workers read through the descriptor, so let them finish before it is closed
+                for _, future in pending:
+                    future.cancel()
+                    if not future.cancelled():
+                        future.exception()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+default_hasher = ChunkHasher()
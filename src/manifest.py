@@ -0,0 +1,69 @@
+import aiohttp
+import asyncio
+import hashlib
+from .utils import serialize, deserialize
+
+MANIFEST_FANOUT = 64    # Entries per manifest page
+MAX_CONCURRENT_FETCHES = 16
+
+
+def page_hash(page):
+    return f"manifest:{hashlib.sha256(page).hexdigest()}"
+
+
+def build_manifest(chunks):
+    """Build a hash tree over a chunk list.
+
+    Leaf pages hold up to MANIFEST_FANOUT [chunk_hash, offset, size] entries and inner pages hold
+    the hashes of their children. Returns the root page hash and a dict of page hashes to pages.
+    """
+    pages = {}
+    level = []
+    for i in range(0, max(len(chunks), 1), MANIFEST_FANOUT):
+        entries = [[c['chunk_hash'], c['offset'], c['size']] for c in chunks[i:i + MANIFEST_FANOUT]]
+        page = serialize({"chunks": entries})
+        level.append(page_hash(page))
+        pages[level[-1]] = page
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level), MANIFEST_FANOUT):
+            page = serialize({"pages": level[i:i + MANIFEST_FANOUT]})
+            parents.append(page_hash(page))
+            pages[parents[-1]] = page
+        level = parents
+    return level[0], pages
+
+
+async def resolve_manifest(root_hash, fetch_page):
+    """Fetch and verify the manifest tree under root_hash and return its chunk metadata in order.
+
+    fetch_page is a coroutine function returning the page bytes for a page hash, or None.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+    async def fetch(hash):
+        async with semaphore:
+            page = await fetch_page(hash)
+        if not page or page_hash(page) != hash:
+            raise ValueError(f"Missing or corrupt manifest page {hash}")
+        return deserialize(page)
+
+    level = [await fetch(root_hash)]
+    while any('pages' in page for page in level):
+        level = await asyncio.gather(*(fetch(hash) for page in level for hash in page.get('pages', [])))
+    return [{"chunk_hash": chunk_hash, "offset": offset, "size": size}
+            for page in level for chunk_hash, offset, size in page['chunks']]
+
+
+async def fetch_manifest_from_peers(session, root_hash, peers):
+    """Resolve a manifest by fetching its pages from the peers' file servers."""
+    async def fetch_page(hash):
+        for peer in peers:
+            try:
+                async with session.get(f"http://{peer}/manifest/{hash}") as response:
+                    if response.status == 200:
+                        return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+        return None
+    return await resolve_manifest(root_hash, fetch_page)
@@ -0,0 +1,96 @@
+import hashlib
+
+MERKLE_BLOCK_SIZE = 64 * 1024    # Bytes covered by each leaf
+MAX_PROOF_LEAVES = 4096    # Largest leaf range a single proof request may cover
+HASH_SIZE = 32
+
+
+def _hash_pair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+def leaf_count(file_size, block_size=MERKLE_BLOCK_SIZE):
+    return (file_size + block_size - 1) // block_size
+
+
+class MerkleTree:
+    """Binary SHA-256 hash tree over fixed-size blocks of a file.
+
+    Each level pairs adjacent nodes; an odd node at the end of a level is carried up unchanged.
+    Levels are kept as concatenated 32-byte digests.
+    """
+    def __init__(self, leaves):
+        self.levels = [bytes(leaves)]
+        while len(self.levels[-1]) > HASH_SIZE:
+            level = self.levels[-1]
+            parents = bytearray()
+            for i in range(0, len(level), 2 * HASH_SIZE):
+                pair = level[i:i + 2 * HASH_SIZE]
+                parents += _hash_pair(pair[:HASH_SIZE], pair[HASH_SIZE:]) if len(pair) > HASH_SIZE else pair
+            self.levels.append(bytes(parents))
+
+    @classmethod
+    def from_file(cls, file_path, file_size, hasher, block_size=MERKLE_BLOCK_SIZE):
+        ranges = ((offset, min(block_size, file_size - offset)) for offset in range(0, file_size, block_size))
+        return cls(b''.join(digest for _, _, digest in hasher.hash_ranges(file_path, ranges)))
+
+    @property
+    def leaves(self):
+        return self.levels[0]
+
+    @property
+    def count(self):
+        return len(self.leaves) // HASH_SIZE
+
+    def root(self):
+        if not self.leaves:
+            return f"merkle:{hashlib.sha256(b'').hexdigest()}"
+        return f"merkle:{self.levels[-1].hex()}"
+
+    def node(self, level, index):
+        return self.levels[level][index * HASH_SIZE:(index + 1) * HASH_SIZE]
+
+    def range_proof(self, first, last):
+        """Return the leaf hashes in [first, last] and the sibling hashes that connect them to the root."""
+        leaves = [self.node(0, i).hex() for i in range(first, last + 1)]
+        proof = []
+        lo, hi = first, last
+        for level in range(len(self.levels) - 1):
+            count = len(self.levels[level]) // HASH_SIZE
+            if lo % 2 == 1:
+                proof.append(self.node(level, lo - 1).hex())
+            if hi % 2 == 0 and hi + 1 < count:
+                proof.append(self.node(level, hi + 1).hex())
+            lo, hi = lo // 2, hi // 2
+        return {"leaves": leaves, "proof": proof}
+
+
+def verify_range_proof(root, count, first, leaves, proof):
+    """Check that leaf hashes starting at index first belong to the tree with the given root."""
+    if not leaves or first < 0 or first + len(leaves) > count:
+        return False
+    nodes = [bytes.fromhex(leaf) for leaf in leaves]
+    siblings = iter(bytes.fromhex(node) for node in proof)
+    lo, hi = first, first + len(leaves) - 1
+    try:
+        while count > 1:
+            if lo % 2 == 1:
+                nodes.insert(0, next(siblings))
+                lo -= 1
+            if hi % 2 == 0 and hi + 1 < count:
+                nodes.append(next(siblings))
+                hi += 1
+            nodes = [_hash_pair(nodes[i], nodes[i + 1]) if i + 1 < len(nodes) else nodes[i]
+                     for i in range(0, len(nodes), 2)]
+            lo, hi, count = lo // 2, hi // 2, (count + 1) // 2
+    except StopIteration:
+        return False
+    return next(siblings, None) is None and f"merkle:{nodes[0].hex()}" == root
+
+
+def verify_blocks(data, first, leaves, block_size=MERKLE_BLOCK_SIZE):
+    """Check block-aligned data against the expected leaf hashes. Returns the index of the first bad block or None."""
+    for i, leaf in enumerate(leaves):
+        if hashlib.sha256(data[i * block_size:(i + 1) * block_size]).hexdigest() != leaf:
+            return first + i
+    return None
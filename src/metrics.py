@@ -0,0 +1,135 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))    # 1 KB to 64 MB
+
+registry = OrderedDict()    # Maps metric names to every metric created in this process
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metric(name, kind, help, samples):
+    """Format samples, a list of (suffix, label names, label values, value), in Prometheus text format."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for suffix, names, values, value in samples:
+        lines.append(f"{name}{suffix}{format_labels(names, values)} {format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}    # Maps label values to their series
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.labels()    # Unlabeled metrics report zero before their first update
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        samples = []
+        for values, child in list(self.children.items()):
+            samples.extend((suffix, names, values + extra, value)
+                           for suffix, names, extra, value in child.samples(self.label_names))
+        return render_metric(self.name, self.kind, self.help, samples)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, names):
+        return [('', names, (), self.value)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # The last slot counts values above every bound
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, names):
+        bucket_names = names + ('le',)
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            samples.append(('_bucket', bucket_names, (bound,), total))
+        samples.append(('_sum', names, (), self.sum))
+        samples.append(('_count', names, (), total))
+        return samples
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def counter(name, help, labels=()):
+    return registry.setdefault(name, Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return registry.setdefault(name, Histogram(name, help, labels, buckets))
+
+
+def render():
+    return ''.join(metric.render() for metric in list(registry.values()))
@@ -0,0 +1,80 @@
+import statistics
+import time
+
+EWMA_WEIGHT = 0.3    # Weight of the newest sample
+MIN_SAMPLES = 3    # Transfers needed before a peer's throughput is trusted
+MAX_ERROR_RATE = 0.5    # Peers failing more often than this are unhealthy
+STRAGGLER_RATIO = 0.25    # Peers slower than this fraction of the fastest are dropped mid-download
+QUARANTINE_TIME = 600    # Seconds a peer that sent bad data is left out of downloads
+
+
+def ewma(average, sample):
+    return sample if average is None else average + EWMA_WEIGHT * (sample - average)
+
+
+class PeerRecord:
+    __slots__ = ('throughput', 'rtt', 'error_rate', 'samples', 'quarantined_until')
+
+    def __init__(self):
+        self.throughput = None    # Bytes per second
+        self.rtt = None    # Seconds until response headers arrive
+        self.error_rate = 0.0
+        self.samples = 0
+        self.quarantined_until = 0
+
+
+class PeerStats:
+    """Moving averages of how each peer has performed, kept by a node across downloads."""
+    def __init__(self):
+        self.records = {}    # Maps peers to PeerRecords
+
+    def record_transfer(self, peer, size, seconds, rtt, failed=False):
+        """Record size bytes received over seconds, including requests cut short or failed partway."""
+        record = self.records.setdefault(peer, PeerRecord())
+        if size and seconds > 0:
+            record.throughput = ewma(record.throughput, size / seconds)
+            record.samples += 1
+        record.rtt = ewma(record.rtt, rtt)
+        if not failed:
+            record.error_rate = ewma(record.error_rate, 0.0)
+
+    def record_error(self, peer):
+        record = self.records.setdefault(peer, PeerRecord())
+        record.error_rate = ewma(record.error_rate, 1.0)
+
+    def quarantine(self, peer):
+        self.records.setdefault(peer, PeerRecord()).quarantined_until = time.monotonic() + QUARANTINE_TIME
+
+    def quarantined(self, peer):
+        record = self.records.get(peer)
+        return record is not None and record.quarantined_until > time.monotonic()
+
+    def known(self, peer):
+        record = self.records.get(peer)
+        return record is not None and record.samples >= MIN_SAMPLES
+
+    def score(self, peer):
+        """Expected useful bytes per second. Peers with too little history score as the median known peer."""
+        if not self.known(peer):
+            record = self.records.get(peer)
+            if record is not None and record.error_rate > MAX_ERROR_RATE:
+                return 0.0
+            scores = [self.score(p) for p in self.records if self.known(p)]
+            return statistics.median(scores) if scores else float('inf')
+        record = self.records[peer]
+        return record.throughput * (1 - record.error_rate)
+
+    def healthy(self, peer):
+        record = self.records.get(peer)
+        return record is None or (record.error_rate <= MAX_ERROR_RATE and not self.quarantined(peer))
+
+    def rank(self, peers):
+        """Order peers from most to least promising: healthy ones first, then by score."""
+        return sorted(peers, key=lambda peer: (not self.healthy(peer), -self.score(peer)))
+
+    def is_straggler(self, peer, peers):
+        """Whether peer is known to be much slower than the fastest known of peers."""
+        if not self.known(peer):
+            return False
+        best = max((self.score(p) for p in peers if self.known(p)), default=0)
+        return self.score(peer) < STRAGGLER_RATIO * best
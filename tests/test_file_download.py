@@ -0,0 +1,92 @@
+import asyncio
+import os
+from src.file_download import FileDownloader
+from src.file_server import FileServer
+from src.file_store import DEFAULT_CHUNK_SIZE, File, FileStore
+from src.peer_stats import PeerStats
+
+SEEDER_PORTS = (18601, 18602)
+
+
+async def download(tmp_path, data, edit_metadata=None, corrupt=(), peer_stats=None):
+    """Share data from two seeders and download it. Returns (result, downloaded bytes or None).
+
+    The bytes at the offsets in corrupt are flipped in the first seeder's copy once it is shared.
+    """
+    servers = []
+    try:
+        for i, port in enumerate(SEEDER_PORTS):
+            directory = tmp_path / f"seed{i}"
+            directory.mkdir()
+            (directory / "f.bin").write_bytes(data)
+            store = FileStore(str(directory), use_index=False)
+            await store.load_files_async()
+            if i == 0:
+                with open(directory / "f.bin", 'r+b') as f:
+                    for offset in corrupt:
+                        f.seek(offset)
+                        f.write(bytes([data[offset] ^ 1]))
+            server = FileServer(store, "127.0.0.1", port)
+            await server.run()
+            servers.append(server)
+        file = next(iter(store.files.values()))
+        metadata = dict(file.metadata(full=True), file_hash=file.hash())
+        if edit_metadata:
+            edit_metadata(metadata)
+        peers = [f"127.0.0.1:{port}" for port in SEEDER_PORTS]
+        chunks = [dict(chunk, peers=peers) for chunk in metadata['chunks']]
+        target = tmp_path / "download"
+        target.mkdir()
+        downloader = FileDownloader(str(target), metadata, chunks, FileStore(str(target), use_index=False),
+                                    peer_stats=peer_stats)
+        result, _ = await downloader.download_file()
+        path = target / "f.bin"
+        return result, path.read_bytes() if path.exists() else None
+    finally:
+        for server in servers:
+            await server.terminate()
+
+
+def repeated_chunk_file():
+    a, b, c = (os.urandom(DEFAULT_CHUNK_SIZE) for _ in range(3))
+    return a + b + a + c[:5000]
+
+
+def test_repeated_chunks_are_all_downloaded(tmp_path):
+    data = repeated_chunk_file()
+    result, downloaded = asyncio.run(download(tmp_path, data))
+    assert result
+    assert downloaded == data
+
+
+def test_chunk_list_with_gap_is_not_trusted(tmp_path):
+    # A chunk list that skips the first copy of a repeated chunk, as older peers published it
+    def drop_first_repeat(metadata):
+        del metadata['chunks'][0]
+        metadata['file_hash'] = File.from_metadata(None, metadata).hash()
+
+    result, downloaded = asyncio.run(download(tmp_path, repeated_chunk_file(), drop_first_repeat))
+    assert not result
+    assert downloaded is None
+
+
+def test_corrupt_seeder_is_repaired_from_the_other(tmp_path):
+    # Without Merkle trees the two seeders are the only peers that can vouch for each other's pieces
+    data = os.urandom(40 * 1024 * 1024)
+    stats = PeerStats()
+    corrupt = range(12345, len(data), 256 * 1024)
+    result, downloaded = asyncio.run(download(tmp_path, data, corrupt=corrupt, peer_stats=stats))
+    assert result
+    assert downloaded == data
+    assert not stats.quarantined(f"127.0.0.1:{SEEDER_PORTS[1]}")
+
+
+def test_corrupt_batch_peer_is_quarantined(tmp_path):
+    # Small files are cut into chunks small enough to be fetched in batches
+    data = os.urandom(2 * 1024 * 1024)
+    stats = PeerStats()
+    result, downloaded = asyncio.run(download(tmp_path, data, corrupt=range(100, len(data), 4096), peer_stats=stats))
+    assert result
+    assert downloaded == data
+    assert stats.quarantined(f"127.0.0.1:{SEEDER_PORTS[0]}")
+    assert not stats.quarantined(f"127.0.0.1:{SEEDER_PORTS[1]}")
@@ -0,0 +1,30 @@
+import asyncio
+import os
+from src.file_store import FileStore
+
+
+async def watch_rename_over_shared_file(directory):
+    """Share files a and b, move b over a, then delete a. Returns the store's files after each step."""
+    (directory / "a").write_bytes(os.urandom(20000))
+    (directory / "b").write_bytes(os.urandom(30000))
+    store = FileStore(str(directory), use_index=False)
+    updates = store.watch(poll_interval=0.05)
+    try:
+        await asyncio.wait_for(updates.__anext__(), 10)
+        before = dict(store.files)
+        os.rename(directory / "b", directory / "a")
+        await asyncio.wait_for(updates.__anext__(), 10)
+        renamed = dict(store.files)
+        os.remove(directory / "a")
+        await asyncio.wait_for(updates.__anext__(), 10)
+        return before, renamed, dict(store.files)
+    finally:
+        await updates.aclose()
+
+
+def test_rename_over_shared_file_replaces_it(tmp_path):
+    before, renamed, deleted = asyncio.run(watch_rename_over_shared_file(tmp_path))
+    assert len(before) == 2
+    assert [file.file_path for file in renamed.values()] == [str(tmp_path / "a")]
+    assert [file.file_size for file in renamed.values()] == [30000]
+    assert deleted == {}